@@ -0,0 +1,86 @@
+from argparse import ArgumentParser
+from itertools import islice
+from pathlib import Path
+from time import perf_counter
+
+import pandas as pd
+import torch
+
+from classification.dataset import (
+    MsgPackIterableDatasetMultiTargetWithDynLabels,
+    FiveCropImageDataset,
+)
+from classification.label_mapping import load_label_mapping
+
+
+def parse_args():
+    args = ArgumentParser(
+        description="Samples per second and core of the dataset decode paths with and "
+        "without reduced-resolution JPEG decoding (jpeg_draft)"
+    )
+    args.add_argument(
+        "--msgpack_dir",
+        type=Path,
+        default=None,
+        help="Directory containing shard_N.msg files (training/validation path)",
+    )
+    args.add_argument(
+        "--label_mapping",
+        type=Path,
+        default=None,
+        help="Label mapping of the images in --msgpack_dir (*.npy or *.json)",
+    )
+    args.add_argument(
+        "--image_dir",
+        type=Path,
+        default=None,
+        help="Folder containing images (FiveCropImageDataset, inference/test path)",
+    )
+    args.add_argument(
+        "--num_samples", type=int, default=1000, help="Maximum number of samples"
+    )
+    return args.parse_args()
+
+
+def samples_per_sec(samples):
+    # single process, i.e. samples per second and core
+    start = perf_counter()
+    n = sum(1 for _ in samples)
+    return n, n / (perf_counter() - start)
+
+
+args = parse_args()
+torch.set_num_threads(1)
+
+rows = []
+for jpeg_draft in [False, True]:
+    if args.msgpack_dir is not None:
+        dataset = MsgPackIterableDatasetMultiTargetWithDynLabels(
+            path=str(args.msgpack_dir),
+            target_mapping=load_label_mapping(args.label_mapping),
+            shuffle=False,
+            jpeg_draft=jpeg_draft,
+        )
+        n, rate = samples_per_sec(islice(dataset, args.num_samples))
+        rows.append(
+            {"dataset": "msgpack", "jpeg_draft": jpeg_draft, "n": n, "samples/s": rate}
+        )
+    if args.image_dir is not None:
+        dataset = FiveCropImageDataset(
+            meta_csv=None, image_dir=args.image_dir, jpeg_draft=jpeg_draft
+        )
+        indices = range(min(len(dataset), args.num_samples))
+        n, rate = samples_per_sec(dataset[i] for i in indices)
+        rows.append(
+            {
+                "dataset": "five_crop",
+                "jpeg_draft": jpeg_draft,
+                "n": n,
+                "samples/s": rate,
+            }
+        )
+
+if len(rows) == 0:
+    raise RuntimeError("Specify --msgpack_dir and/or --image_dir")
+df = pd.DataFrame.from_records(rows).set_index(["dataset", "jpeg_draft"])
+print(df)
@@ -0,0 +1,142 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from math import ceil
+from time import perf_counter
+
+import pandas as pd
+import torch
+from tqdm.auto import tqdm
+
+from classification.train_base import MultiPartitioningClassifier
+from classification.dataset import FiveCropImageDataset
+
+
+def parse_args():
+    args = ArgumentParser(
+        description="Throughput and agreement with the dense classifiers of the "
+        "coarse-to-fine pruned evaluation (MultiPartitioningClassifier.inference with "
+        "topk_coarse)"
+    )
+    args.add_argument(
+        "--checkpoint",
+        type=Path,
+        default=Path("models/base_M/epoch=014-val_loss=18.4833.ckpt"),
+        help="Checkpoint to already trained model (*.ckpt)",
+    )
+    args.add_argument(
+        "--hparams",
+        type=Path,
+        default=Path("models/base_M/hparams.yaml"),
+        help="Path to hparams file (*.yaml) generated during training",
+    )
+    args.add_argument(
+        "--image_dir",
+        type=Path,
+        default=Path("resources/images/im2gps"),
+        help="Folder containing images. Supported file extensions: (*.jpg, *.jpeg, *.png)",
+    )
+    args.add_argument(
+        "--topk_coarse",
+        type=int,
+        nargs="+",
+        default=[1, 5, 10, 25, 50],
+        help="Whitespace separated list of k to evaluate",
+    )
+    args.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of timed passes over the extracted features",
+    )
+    # environment
+    args.add_argument(
+        "--gpu",
+        action="store_true",
+        help="Use GPU for inference if CUDA is available",
+    )
+    args.add_argument("--batch_size", type=int, default=64)
+    args.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of workers for image loading and pre-processing",
+    )
+    return args.parse_args()
+
+
+def predict(model, fv, ncrops, topk_coarse):
+    yhats = model.multi_crop_log_probs(fv, ncrops, topk_coarse)
+    preds = [torch.argmax(yhat, dim=1) for yhat in yhats]
+    if model.hierarchy is not None:
+        preds.append(torch.argmax(model.hierarchy_scores(yhats), dim=1))
+    return preds
+
+
+def benchmark(model, features, topk_coarse, repeats):
+    # classifiers only, the features of the backbone are the same for all k
+    preds = []
+    start = perf_counter()
+    for _ in range(repeats):
+        preds = [predict(model, fv, ncrops, topk_coarse) for fv, ncrops in features]
+    if features[0][0].is_cuda:
+        torch.cuda.synchronize()
+    elapsed = (perf_counter() - start) / repeats
+    return [torch.cat(p) for p in zip(*preds)], elapsed
+
+
+args = parse_args()
+
+print("Load model from ", args.checkpoint)
+model = MultiPartitioningClassifier.load_from_checkpoint(
+    checkpoint_path=str(args.checkpoint),
+    hparams_file=str(args.hparams),
+    map_location=None,
+)
+model.eval()
+if args.gpu and torch.cuda.is_available():
+    model.cuda()
+
+dataloader = torch.utils.data.DataLoader(
+    FiveCropImageDataset(meta_csv=None, image_dir=args.image_dir),
+    batch_size=ceil(args.batch_size / 5),
+    shuffle=False,
+    num_workers=args.num_workers,
+)
+print("Number of images: ", len(dataloader.dataset))
+if len(dataloader.dataset) == 0:
+    raise RuntimeError(f"No images found in {args.image_dir}")
+
+pnames = [p.shortname for p in model.partitionings]
+if model.hierarchy is not None:
+    pnames.append("hierarchy")
+
+with torch.no_grad():
+    print("Extract features")
+    features = []
+    for images, _ in tqdm(dataloader):
+        if args.gpu:
+            images = images.cuda()
+        ncrops = images.shape[1]
+        images = torch.reshape(images, (-1, *images.shape[2:]))
+        features.append((model.model(images), ncrops))
+
+    dense_preds, dense_time = benchmark(model, features, None, args.repeats)
+    rows = [
+        {
+            "topk_coarse": "dense",
+            "classifier img/s": len(dataloader.dataset) / dense_time,
+        }
+    ]
+    for topk_coarse in args.topk_coarse:
+        preds, elapsed = benchmark(model, features, topk_coarse, args.repeats)
+        row = {
+            "topk_coarse": topk_coarse,
+            "classifier img/s": len(dataloader.dataset) / elapsed,
+        }
+        for pname, pred, dense_pred in zip(pnames, preds, dense_preds):
+            # fraction of images with the same prediction as the dense classifiers
+            row[f"agreement/{pname}"] = (pred == dense_pred).float().mean().item()
+        rows.append(row)
+
+df = pd.DataFrame.from_records(rows).set_index("topk_coarse")
+print(df)
@@ -1,104 +1,309 @@
 import os
 import sys
-import re
+import heapq
+import logging
+import queue
+import threading
+from itertools import chain, groupby, islice
 from math import ceil
-from typing import Dict, List, Tuple, Union
+from time import perf_counter
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
 from io import BytesIO
 import random
 from pathlib import Path
-from multiprocessing import Pool
+from multiprocessing import Array, Pool
 
+import numpy as np
 import pandas as pd
 from PIL import Image
 import torchvision
 import torch
 import msgpack
 
+from classification.label_mapping import LabelMapping
+from classification.mmap_reader import (
+    MemoryviewReader,
+    iter_record_views,
+    map_shard,
+    unpack_view,
+    will_need,
+)
+from classification.shard_index import (
+    list_shards,
+    load_shard_index,
+    load_shard_labels,
+    shard_index_path,
+)
+
+
+def open_image(fp, draft_size: Tuple[int, int] = None) -> Image.Image:
+    """Open an image in RGB mode. With draft_size (width, height), JPEGs are decoded
+    directly at a reduced scale (1/2, 1/4 or 1/8) that is still at least draft_size,
+    which is much faster than decoding at full resolution and resizing afterwards.
+    """
+    img = Image.open(fp)
+    if draft_size is not None:
+        img.draft("RGB", draft_size)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img
+
+
+def initial_resize(img: Image.Image, size: int = 320) -> Image.Image:
+    # short side to size if both sides are larger
+    if img.width > size and img.height > size:
+        img = torchvision.transforms.Resize(size)(img)
+    return img
+
+
+def pil_to_uint8_tensor(img: Image.Image) -> torch.Tensor:
+    # [C, H, W] uint8 tensor without scaling, i.e. a quarter of the bytes of ToTensor
+    return torch.from_numpy(np.array(img, dtype=np.uint8)).permute(2, 0, 1)
 
-class MsgPackIterableDatasetMultiTargetWithDynLabels(torch.utils.data.IterableDataset):
+
+def img_shape_key(key_img_encoded: bytes) -> bytes:
+    # [height, width, channels] of images stored as raw uint8 arrays (repack_shards.py)
+    return key_img_encoded + b"_shape"
+
+
+class ShuffleBuffer:
+    """Streaming shuffle of samples bounded by their size in bytes.
+    As long as the buffered samples exceed max_bytes, a random one is released, i.e.
+    once the buffer is warm about one sample is released per inserted sample.
+    The high-water mark (peak_bytes, peak_samples) helps to tune the budget.
     """
-    Data source: bunch of msgpack files
-    Target values are generated on the fly given a mapping (id->[target1, target, ...])
+
+    def __init__(self, max_bytes: int, rng=random):
+        self.max_bytes = max_bytes
+        self.rng = rng
+        self.samples = []
+        self.sizes = []
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.peak_samples = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _pop(self, i: int):
+        # swap with the last sample, i.e. O(1)
+        self.samples[i], self.samples[-1] = self.samples[-1], self.samples[i]
+        self.sizes[i], self.sizes[-1] = self.sizes[-1], self.sizes[i]
+        self.bytes -= self.sizes.pop()
+        return self.samples.pop()
+
+    def shuffle(self, samples: Iterable[Tuple[Any, int]]) -> Iterator[Any]:
+        """Shuffle a stream of (sample, size in bytes)"""
+        for sample, size in samples:
+            self.samples.append(sample)
+            self.sizes.append(size)
+            self.bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self.peak_samples = max(self.peak_samples, len(self.samples))
+            while self.bytes > self.max_bytes:
+                yield self._pop(self.rng.randrange(len(self.samples)))
+        # end of stream
+        while self.samples:
+            yield self._pop(self.rng.randrange(len(self.samples)))
+
+
+# bytes read at once from shards, i.e. unit of the readahead
+READ_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class Readahead:
+    """Runs an iterable on a background thread, at most depth items ahead of the
+    consumer. Reading files on the thread overlaps I/O with decoding and augmentation
+    on the consumer thread. The time the consumer waits for items is accumulated in
+    stall_time, i.e. a high stall time means that storage is the bottleneck.
     """
 
-    def __init__(
+    _END = object()
+
+    def __init__(self, iterable: Iterable, depth: int):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stall_time = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put((item, None)):
+                    return
+        except Exception as e:
+            # raised on the consumer thread
+            self._put((None, e))
+        finally:
+            # e.g. close files of a generator stopped early
+            if hasattr(iterable, "close"):
+                iterable.close()
+        self._put((self._END, None))
+
+    def __iter__(self):
+        while True:
+            start = perf_counter()
+            item, error = self.queue.get()
+            self.stall_time += perf_counter() - start
+            if error is not None:
+                raise error
+            if item is self._END:
+                return
+            yield item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def balance_shards(
+    sizes: List[int], num_parts: int, rng: random.Random = None
+) -> List[List[int]]:
+    """Split shards into num_parts lists of indexes with a similar total size
+    (greedy, largest shard first). With rng, the order of the parts and the shard
+    order within each part are shuffled.
+    """
+    parts = [[] for _ in range(num_parts)]
+    loads = [(0, p) for p in range(num_parts)]
+    for i in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        load, p = heapq.heappop(loads)
+        parts[p].append(i)
+        heapq.heappush(loads, (load + sizes[i], p))
+    if rng is not None:
+        rng.shuffle(parts)
+        for part in parts:
+            rng.shuffle(part)
+    return parts
+
+
+class _MsgPackSampleMixin:
+    """Target values, decoding and meta information of msgpack records shared by the
+    msgpack datasets
+    """
+
+    def _init_samples(
         self,
-        path: str,
-        target_mapping: Dict[str, int],
-        key_img_id: str = "id",
-        key_img_encoded: str = "image",
-        transformation=None,
-        shuffle=True,
-        meta_path=None,
-        cache_size=6 * 4096,
-        lat_key="LAT",
-        lon_key="LON",
+        target_mapping,
+        key_img_id,
+        key_img_encoded,
+        transformation,
+        meta_path,
+        lat_key,
+        lon_key,
+        jpeg_draft,
+        embedded_labels,
+        mmap_shards,
     ):
-
-        super(MsgPackIterableDatasetMultiTargetWithDynLabels, self).__init__()
-        self.path = path
-        self.cache_size = cache_size
         self.transformation = transformation
-        self.shuffle = shuffle
-        self.seed = random.randint(1, 100)
+        self.jpeg_draft = jpeg_draft
+        # records parsed in place from memory-mapped shards, images are memoryviews
+        self.mmap_shards = mmap_shards
         self.key_img_id = key_img_id.encode("utf-8")
         self.key_img_encoded = key_img_encoded.encode("utf-8")
+        self.key_img_shape = img_shape_key(self.key_img_encoded)
+        # targets and coordinates stored next to the shards (shard_N.labels.npy),
+        # target_mapping and meta information are not needed
+        self.embedded_labels = embedded_labels
         self.target_mapping = target_mapping
 
-        for k, v in self.target_mapping.items():
-            if not isinstance(v, list):
-                self.target_mapping[k] = [v]
-        if len(self.target_mapping) == 0:
-            raise ValueError("No samples found.")
-
-        if not isinstance(self.path, (list, set)):
-            self.path = [self.path]
+        if not self.embedded_labels:
+            if isinstance(self.target_mapping, dict):
+                for k, v in self.target_mapping.items():
+                    if not isinstance(v, list):
+                        self.target_mapping[k] = [v]
+            if len(self.target_mapping) == 0:
+                raise ValueError("No samples found.")
 
         self.meta_path = meta_path
-        if meta_path is not None:
+        if meta_path is not None and not self.embedded_labels:
             self.meta = pd.read_csv(meta_path, index_col=0)
             self.meta = self.meta.astype({lat_key: "float32", lon_key: "float32"})
             self.lat_key = lat_key
             self.lon_key = lon_key
 
-        self.shards = self.__init_shards(self.path)
-        self.length = len(self.target_mapping)
+    def _shard_records(self, shard_path, shard_id: int = 0):
+        """Location (and embedded labels) of the records of a shard with target
+        value(s), None for shards without index (see classification/shard_index.py)
+        """
+        if not shard_index_path(shard_path).exists():
+            if self.embedded_labels:
+                raise ValueError(f"No index and labels of {shard_path}")
+            return None
+        index = load_shard_index(shard_path)
+        fields = [("shard", "<i4"), ("offset", "<u8"), ("length", "<u8")]
+        if self.embedded_labels:
+            labels = load_shard_labels(shard_path)
+            wanted = (labels["targets"] >= 0).all(axis=1)
+            fields += [(name, labels.dtype[name]) for name in ["targets", "lat_lng"]]
+        else:
+            wanted = self._in_target_mapping(index)
+
+        records = np.empty(np.count_nonzero(wanted), dtype=fields)
+        records["shard"] = shard_id
+        records["offset"] = index["offset"][wanted]
+        records["length"] = index["length"][wanted]
+        if self.embedded_labels:
+            records["targets"] = labels["targets"][wanted]
+            records["lat_lng"] = labels["lat_lng"][wanted]
+            # samples with coordinates are requested by meta_path
+            unknown = np.count_nonzero(np.isnan(records["lat_lng"]).any(axis=1))
+            if self.meta_path is not None and unknown > 0:
+                raise ValueError(
+                    f"Labels of {shard_path} have no coordinates for {unknown} "
+                    "records, embed them with --meta_path"
+                )
+        return records
+
+    def _in_target_mapping(self, index: np.ndarray) -> np.ndarray:
+        # records of a shard index with a target value
+        if isinstance(self.target_mapping, LabelMapping):
+            return self.target_mapping.index_hashes(index["id_hash"]) >= 0
+        return np.array(
+            [_id.decode("utf-8") in self.target_mapping for _id in index["id"]],
+            dtype=bool,
+        )
+
+    def _target(self, _id: str):
+        # target value(s) of an image, raises a KeyError for unknown images
+        return self._unpack_target(self.target_mapping[_id])
 
     @staticmethod
-    def __init_shards(path: Union[str, Path]) -> list:
-        shards = []
-        for i, p in enumerate(path):
-            shards_re = r"shard_(\d+).msg"
-            shards_index = [
-                int(re.match(shards_re, x).group(1))
-                for x in os.listdir(p)
-                if re.match(shards_re, x)
-            ]
-            shards.extend(
-                [
-                    {
-                        "path_index": i,
-                        "path": p,
-                        "shard_index": s,
-                        "shard_path": os.path.join(p, f"shard_{s}.msg"),
-                    }
-                    for s in shards_index
-                ]
-            )
-        if len(shards) == 0:
-            raise ValueError("No shards found")
-        return shards
+    def _unpack_target(target: List[int]):
+        if len(target) == 1:
+            return target[0]
+        return target
 
     def _process_sample(self, x):
         # prepare image and target value
 
         # decode and initial resize if necessary
-        img = Image.open(BytesIO(x[self.key_img_encoded]))
-        if img.mode != "RGB":
-            img = img.convert("RGB")
-
-        if img.width > 320 and img.height > 320:
-            img = torchvision.transforms.Resize(320)(img)
+        if self.key_img_shape in x:
+            # already decoded and resized
+            height, width, _ = x[self.key_img_shape]
+            img = Image.frombuffer(
+                "RGB", (width, height), x[self.key_img_encoded], "raw", "RGB", 0, 1
+            )
+        else:
+            data = x[self.key_img_encoded]
+            img = open_image(
+                (
+                    MemoryviewReader(data)
+                    if isinstance(data, memoryview)
+                    else BytesIO(data)
+                ),
+                (320, 320) if self.jpeg_draft else None,
+            )
+        img = initial_resize(img)
 
         # apply all user specified image transformations
         if self.transformation is not None:
@@ -106,82 +311,630 @@ class MsgPackIterableDatasetMultiTargetWithDynLabels(torch.utils.data.IterableDa
 
         if self.meta_path is None:
             return img, x["target"]
+        elif "lat_lng" in x:
+            return img, x["target"], x["lat_lng"][0], x["lat_lng"][1]
         else:
             _id = x[self.key_img_id].decode("utf-8")
             meta = self.meta.loc[_id]
             return img, x["target"], meta[self.lat_key], meta[self.lon_key]
 
-    def __iter__(self):
 
-        shard_indices = list(range(len(self.shards)))
+class MsgPackIterableDatasetMultiTargetWithDynLabels(
+    _MsgPackSampleMixin, torch.utils.data.IterableDataset
+):
+    """
+    Data source: bunch of msgpack files
+    Target values are generated on the fly given a mapping (id->[target1, target, ...])
+    either as dict or memory-mapped LabelMapping, or read from the shard labels
+    (embedded_labels)
+    """
 
-        if self.shuffle:
-            random.seed(self.seed)
-            random.shuffle(shard_indices)
+    def __init__(
+        self,
+        path: str,
+        target_mapping: Union[Dict[str, int], LabelMapping, None],
+        key_img_id: str = "id",
+        key_img_encoded: str = "image",
+        transformation=None,
+        shuffle=True,
+        meta_path=None,
+        shuffle_buffer_mb=256,
+        readahead_mb=64,
+        lat_key="LAT",
+        lon_key="LON",
+        jpeg_draft=False,
+        embedded_labels=False,
+        mmap_shards=False,
+        seed=0,
+        rank=None,
+        world_size=None,
+    ):
 
-        worker_info = torch.utils.data.get_worker_info()
+        super(MsgPackIterableDatasetMultiTargetWithDynLabels, self).__init__()
+        self.path = path
+        # memory budget of the shuffle buffer per worker (raw encoded images)
+        self.shuffle_buffer_mb = shuffle_buffer_mb
+        # raw shard data read ahead on a background thread per worker, 0: disabled
+        self.readahead_mb = readahead_mb
+        self.shuffle = shuffle
+        # shard order and shuffling depend on seed and epoch only, i.e. all ranks agree
+        self.seed = seed
+        self.epoch = 0
+        # iteration state of each worker shared with the main process (track_progress)
+        # and the state to continue an interrupted epoch from (load_state_dict)
+        self.progress = None
+        self.emitted = None
+        self._resume = None
+        if rank is None or world_size is None:
+            distributed = (
+                torch.distributed.is_available() and torch.distributed.is_initialized()
+            )
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+        self._init_samples(
+            target_mapping,
+            key_img_id,
+            key_img_encoded,
+            transformation,
+            meta_path,
+            lat_key,
+            lon_key,
+            jpeg_draft,
+            embedded_labels,
+            mmap_shards,
+        )
 
-        if worker_info is not None:
+        if not isinstance(self.path, (list, set)):
+            self.path = [self.path]
 
-            def split_list(alist, splits=1):
-                length = len(alist)
-                return [
-                    alist[i * length // splits : (i + 1) * length // splits]
-                    for i in range(splits)
+        self.shards = list_shards(self.path)
+        # records with a target value of each indexed shard, None for shards without
+        # index
+        self.shard_records = [
+            self._shard_records(s["shard_path"], i) for i, s in enumerate(self.shards)
+        ]
+        self.indexed = all(records is not None for records in self.shard_records)
+        if self.indexed:
+            self.length = sum(len(records) for records in self.shard_records)
+            # records of shard i are numbered from record_offsets[i] on
+            self.record_offsets = np.cumsum(
+                [0] + [len(records) for records in self.shard_records]
+            )
+        else:
+            if self.world_size > 1:
+                # ranks with a different number of batches wait for each other forever
+                raise ValueError(
+                    "Distributed training requires an index of all shards "
+                    "(see classification/shard_index.py)"
+                )
+            self.length = len(self.target_mapping)
+        # wanted bytes for indexed shards
+        self.shard_bytes = [
+            (
+                os.path.getsize(s["shard_path"])
+                if records is None
+                else int(records["length"].sum())
+            )
+            for s, records in zip(self.shards, self.shard_records)
+        ]
+
+    def set_epoch(self, epoch: int):
+        # called before each epoch, i.e. before workers are started
+        self.epoch = epoch
+        self._resume = None
+
+    def track_progress(self, num_workers: int):
+        """Share the position of each of num_workers data loader workers with this
+        process, see state_dict. Called before the workers are started.
+        """
+        # [shard position in the part of the worker, next record, records read]
+        self.progress = Array("q", 3 * max(1, num_workers))
+        # 1 for records of indexed shards passed to the data loader, i.e. records that
+        # were read but are not marked are held in a shuffle buffer
+        if self.indexed:
+            self.emitted = Array("b", self.length, lock=False)
+
+    def _emitted_records(self):
+        # writable view of emitted, None if not tracked
+        if self.emitted is None:
+            return None
+        return np.frombuffer(self.emitted, dtype=np.int8)
+
+    def _part_records(self, part: List[int], shard_position: int, first_record: int):
+        # numbers of the records of a part before a position
+        ranges = [
+            np.arange(self.record_offsets[i], self.record_offsets[i + 1])
+            for i in part[:shard_position]
+        ]
+        if shard_position < len(part):
+            start = self.record_offsets[part[shard_position]]
+            ranges.append(np.arange(start, start + first_record))
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+    def _set_progress(self, worker_id, shard_position, record_offset, num_records):
+        if self.progress is not None:
+            with self.progress.get_lock():
+                self.progress[3 * worker_id : 3 * worker_id + 3] = [
+                    shard_position,
+                    record_offset,
+                    num_records,
                 ]
 
-            shard_indices_split = split_list(shard_indices, worker_info.num_workers)[
-                worker_info.id
-            ]
-
+    def _finish_progress(self, worker_id):
+        if self.progress is not None:
+            with self.progress.get_lock():
+                self.progress[3 * worker_id] = -1
+
+    def state_dict(self) -> dict:
+        """Iteration state (seed, epoch and for each worker: position of the current
+        shard in its part of the shards, next record of that shard, records read so
+        far, -1 as shard position if finished) to continue an interrupted epoch.
+        For indexed shards, the records read but still held in the shuffle buffer of
+        each worker ([shard index, record] pairs) are read again when continuing.
+        Samples in the data loader queues (prefetched batches) are skipped.
+        """
+        state = {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "world_size": self.world_size,
+            "workers": None,
+            "pending": None,
+        }
+        if self.progress is None:
+            return state
+        with self.progress.get_lock():
+            progress = list(self.progress)
+        state["workers"] = [progress[i : i + 3] for i in range(0, len(progress), 3)]
+
+        emitted = self._emitted_records()
+        if emitted is not None:
+            num_workers = len(state["workers"])
+            parts = self._parts(num_workers)
+            state["pending"] = []
+            for worker_id, (shard_position, first_record, _) in enumerate(
+                state["workers"]
+            ):
+                read = np.empty(0, dtype=np.int64)
+                if shard_position != -1:
+                    read = self._part_records(
+                        parts[self.rank * num_workers + worker_id],
+                        shard_position,
+                        first_record,
+                    )
+                pending = read[emitted[read] == 0]
+                shards = np.searchsorted(self.record_offsets, pending, side="right") - 1
+                state["pending"].append(
+                    np.stack([shards, pending - self.record_offsets[shards]], axis=1)
+                )
+        return state
+
+    def load_state_dict(self, state: dict):
+        self.seed = state["seed"]
+        self.set_epoch(state["epoch"])
+        workers = state["workers"]
+        if workers is None:
+            return
+        if all(w[0] == -1 for w in workers):
+            # epoch was completed
+            self.set_epoch(state["epoch"] + 1)
+        elif state["world_size"] != self.world_size:
+            logging.warning(
+                f"Iteration state of {state['world_size']} ranks, restart epoch "
+                f"{self.epoch}"
+            )
         else:
-            shard_indices_split = shard_indices
+            pending = state.get("pending")
+            if pending is None or not self.indexed:
+                logging.warning(
+                    "Iteration state without the records of the shuffle buffers, "
+                    "buffered samples of the interrupted epoch are skipped"
+                )
+                pending = None
+            self._resume = (workers, pending)
+
+    def _resume_position(self, part: List[int], worker_id: int, num_workers: int):
+        # (shard position, next record, records read, [shard index, record] pairs to
+        # read again) of this worker
+        no_pending = np.empty((0, 2), dtype=np.int64)
+        if self._resume is None:
+            return 0, 0, 0, no_pending
+        workers, pending = self._resume
+        if len(workers) != num_workers:
+            logging.warning(
+                f"Iteration state of {len(workers)} workers, restart epoch "
+                f"{self.epoch}"
+            )
+            return 0, 0, 0, no_pending
+        shard_position, record_offset, num_records = workers[worker_id]
+        pending = no_pending if pending is None else np.asarray(pending[worker_id])
+        if shard_position == -1 or not self.indexed or self.world_size == 1:
+            return shard_position, record_offset, num_records, pending
+
+        # state of rank 0 (Lightning saves checkpoints on rank 0 only), i.e. continue
+        # after the same number of records on all ranks. Other ranks don't know the
+        # records of their shuffle buffers and continue after the records passed on.
+        if self.rank != 0:
+            num_records -= len(pending)
+            pending = no_pending
+        shard_position, record_offset = 0, num_records
+        while shard_position < len(part):
+            shard_length = len(self.shard_records[part[shard_position]])
+            if record_offset < shard_length:
+                break
+            record_offset -= shard_length
+            shard_position += 1
+        return shard_position, record_offset, num_records, pending
+
+    def _shard_blocks(self, shard_indices, first_record=0):
+        """Raw data of shards in blocks of about READ_BLOCK_SIZE bytes:
+        (shard index, index of the first record, [record, ...]) for indexed shards,
+        (shard index, None, chunk of the file) otherwise.
+        Indexed shards start at first_record (first shard only).
+        """
+        for n, shard_index in enumerate(shard_indices):
+            first = first_record if n == 0 else 0
+            if self.mmap_shards:
+                yield from self._shard_views(shard_index, first)
+                continue
+            records = self.shard_records[shard_index]
+            with open(self.shards[shard_index]["shard_path"], "rb") as f:
+                if records is None:
+                    chunk = f.read(READ_BLOCK_SIZE)
+                    while chunk:
+                        yield shard_index, None, chunk
+                        chunk = f.read(READ_BLOCK_SIZE)
+                    continue
+
+                # read wanted records only, others are never loaded or unpacked
+                offsets = records["offset"][first:].tolist()
+                lengths = records["length"][first:].tolist()
+                start, block, size = first, [], 0
+                for i, (offset, length) in enumerate(zip(offsets, lengths), first):
+                    block.append(os.pread(f.fileno(), length, offset))
+                    size += length
+                    if size >= READ_BLOCK_SIZE:
+                        yield shard_index, start, block
+                        start, block, size = i + 1, [], 0
+                if block:
+                    yield shard_index, start, block
+
+    def _record_blocks(self, pending):
+        # like _shard_blocks, but single records of [shard index, record] pairs
+        for shard_index, group in groupby(pending.tolist(), key=lambda r: r[0]):
+            records = self.shard_records[shard_index]
+            with open(self.shards[shard_index]["shard_path"], "rb") as f:
+                for _, i in group:
+                    data = os.pread(
+                        f.fileno(), int(records["length"][i]), int(records["offset"][i])
+                    )
+                    yield shard_index, i, [data]
+
+    def _shard_views(self, shard_index, first=0):
+        # like _shard_blocks, but records are memoryviews of the memory-mapped shard
+        mm = map_shard(self.shards[shard_index]["shard_path"])
+        if mm is None:
+            return
+        view = memoryview(mm)
+        records = self.shard_records[shard_index]
+        if records is None:
+            first = 0
+            views = iter_record_views(view)
+        else:
+            views = (
+                (offset, view[offset : offset + length])
+                for offset, length in zip(
+                    records["offset"][first:].tolist(),
+                    records["length"][first:].tolist(),
+                )
+            )
+
+        start, block, size = first, [], 0
+        for i, (offset, record) in enumerate(views, first):
+            if len(block) == 0:
+                block_offset = offset
+            block.append(record)
+            size += len(record)
+            if size >= READ_BLOCK_SIZE:
+                # pages of the block are read asynchronously by the kernel
+                will_need(mm, block_offset, offset + len(record))
+                yield shard_index, start, block
+                start, block, size = i + 1, [], 0
+        if block:
+            will_need(mm, block_offset, offset + len(record))
+            yield shard_index, start, block
+
+    def _unpack_blocks(self, blocks):
+        # (shard index, record index, record)
+        unpacker, unpacker_shard = None, None
+        for shard_index, start, block in blocks:
+            if start is None:
+                if shard_index != unpacker_shard:
+                    unpacker = msgpack.Unpacker(
+                        max_buffer_size=1024 * 1024 * 1024, raw=True
+                    )
+                    unpacker_shard, i = shard_index, 0
+                unpacker.feed(block)
+                for x in unpacker:
+                    if x is not None:
+                        yield shard_index, i, x
+                        i += 1
+                continue
+
+            records = self.shard_records[shard_index]
+            for i, data in enumerate(block, start=start):
+                if isinstance(data, memoryview):
+                    x = unpack_view(data, (self.key_img_encoded,))
+                else:
+                    x = msgpack.unpackb(data, raw=True)
+                if self.embedded_labels:
+                    x["target"] = self._unpack_target(records["targets"][i].tolist())
+                    x["lat_lng"] = records["lat_lng"][i]
+                if self.indexed:
+                    x["record"] = int(self.record_offsets[shard_index]) + i
+                yield shard_index, i, x
+
+    def _track(
+        self, records, part, worker_id, shard_position, first_record, num_records
+    ):
+        # records of the part of a worker read from shard_position on, sets its
+        # progress as positions in the whole part
+        positions = {shard_index: p for p, shard_index in enumerate(part)}
+        for shard_index, i, x in records:
+            # shards without index can not be entered at first_record
+            if positions[shard_index] == shard_position and i < first_record:
+                continue
+            num_records += 1
+            self._set_progress(worker_id, positions[shard_index], i + 1, num_records)
+            yield x
 
-        cache = []
+    def __iter__(self):
 
-        for shard_index in shard_indices_split:
-            shard = self.shards[shard_index]
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        worker_id = 0 if worker_info is None else worker_info.id
+
+        parts = self._parts(num_workers)
+        part = self.rank * num_workers + worker_id
+        num_shards = sum(len(p) for p in parts)
+        if num_shards < len(parts):
+            logging.warning(
+                f"{num_shards} shards for {len(parts)} workers of all ranks, "
+                "some workers have no samples"
+            )
 
-            with open(
-                os.path.join(shard["path"], f"shard_{shard['shard_index']}.msg"), "rb"
-            ) as f:
-                unpacker = msgpack.Unpacker(
-                    f, max_buffer_size=1024 * 1024 * 1024, raw=True
+        shard_position, first_record, num_records, pending = self._resume_position(
+            parts[part], worker_id, num_workers
+        )
+        if shard_position == -1:
+            # finished before the interruption
+            self._set_progress(worker_id, -1, first_record, num_records)
+            return
+        part_shards = parts[part][shard_position:]
+        self._set_progress(worker_id, shard_position, first_record, num_records)
+
+        emitted = self._emitted_records()
+        if emitted is not None:
+            # records before the position were passed on, except the pending ones
+            emitted[self._part_records(parts[part], len(parts[part]), 0)] = 0
+            emitted[self._part_records(parts[part], shard_position, first_record)] = 1
+            emitted[self.record_offsets[pending[:, 0]] + pending[:, 1]] = 0
+
+        blocks = self._shard_blocks(part_shards, first_record)
+        readahead = None
+        if self.readahead_mb > 0:
+            readahead = Readahead(
+                blocks, max(1, self.readahead_mb * 1024 * 1024 // READ_BLOCK_SIZE)
+            )
+            blocks = readahead
+
+        samples = self._target_samples(
+            self._track(
+                self._unpack_blocks(blocks),
+                parts[part],
+                worker_id,
+                shard_position,
+                first_record,
+                num_records,
+            )
+        )
+        if self.world_size > 1 and self.indexed:
+            # the same number of samples for this worker on all ranks, i.e. the same
+            # number of batches, otherwise ranks wait for each other forever
+            part_samples = [
+                sum(
+                    len(self.shard_records[i])
+                    for i in parts[r * num_workers + worker_id]
+                )
+                for r in range(self.world_size)
+            ]
+            num_samples = min(part_samples)
+            if part_samples[self.rank] > num_samples:
+                logging.info(
+                    f"Rank {self.rank} worker {worker_id}: skip "
+                    f"{part_samples[self.rank] - num_samples} of "
+                    f"{part_samples[self.rank]} samples in epoch {self.epoch} to "
+                    "yield as many samples as the other ranks"
+                )
+            samples = islice(samples, max(0, num_samples - num_records))
+        if len(pending) > 0:
+            logging.info(
+                f"Rank {self.rank} worker {worker_id}: read {len(pending)} records of "
+                "the interrupted shuffle buffer again"
+            )
+            samples = chain(
+                self._target_samples(
+                    x for _, _, x in self._unpack_blocks(self._record_blocks(pending))
+                ),
+                samples,
+            )
+
+        try:
+            if not self.shuffle:
+                for x in samples:
+                    if emitted is not None:
+                        emitted[x["record"]] = 1
+                    yield self._process_sample(x)
+            else:
+                buffer = ShuffleBuffer(
+                    self.shuffle_buffer_mb * 1024 * 1024,
+                    random.Random(
+                        f"{self.seed}/{self.epoch}/{part}/{shard_position}/{first_record}"
+                    ),
+                )
+                for x in buffer.shuffle(
+                    (x, len(x[self.key_img_encoded])) for x in samples
+                ):
+                    if emitted is not None:
+                        emitted[x["record"]] = 1
+                    yield self._process_sample(x)
+                logging.info(
+                    f"Shuffle buffer of rank {self.rank} worker {worker_id}: "
+                    f"high-water mark {buffer.peak_bytes / 1024 / 1024:.1f} MB, "
+                    f"{buffer.peak_samples} samples"
+                )
+            self._finish_progress(worker_id)
+        finally:
+            if readahead is not None:
+                readahead.close()
+                logging.info(
+                    f"Readahead of rank {self.rank} worker {worker_id}: "
+                    f"{readahead.stall_time:.1f} s waiting for data"
                 )
-                for x in unpacker:
-                    if x is None:
-                        continue
-
-                    # valid dataset sample?
-                    _id = x[self.key_img_id].decode("utf-8")
-                    try:
-                        # set target value dynamically
-                        if len(self.target_mapping[_id]) == 1:
-                            x["target"] = self.target_mapping[_id][0]
-                        else:
-                            x["target"] = self.target_mapping[_id]
-                    except KeyError:
-                        # reject sample
-                        # print(f'reject {_id} {type(_id)}')
-                        continue
-
-                    if len(cache) < self.cache_size:
-                        cache.append(x)
-
-                    if len(cache) == self.cache_size:
-
-                        if self.shuffle:
-                            random.shuffle(cache)
-                        while cache:
-                            yield self._process_sample(cache.pop())
-        if self.shuffle:
-            random.shuffle(cache)
-
-        while cache:
-            yield self._process_sample(cache.pop())
+
+    def _parts(self, num_workers: int) -> List[List[int]]:
+        # shards of each worker of each rank, one part of similar size in bytes each.
+        # Shards without any wanted record are skipped entirely.
+        shard_indices = [
+            i
+            for i, records in enumerate(self.shard_records)
+            if records is None or len(records) > 0
+        ]
+        parts = balance_shards(
+            [self.shard_bytes[i] for i in shard_indices],
+            self.world_size * num_workers,
+            random.Random(f"{self.seed}/{self.epoch}") if self.shuffle else None,
+        )
+        return [[shard_indices[i] for i in part] for part in parts]
+
+    def _target_samples(self, records):
+        for x in records:
+
+            # valid dataset sample?
+            if "target" not in x:
+                _id = x[self.key_img_id].decode("utf-8")
+                try:
+                    # set target value dynamically
+                    x["target"] = self._target(_id)
+                except KeyError:
+                    # reject sample
+                    # print(f'reject {_id} {type(_id)}')
+                    continue
+            yield x
 
     def __len__(self):
-        return self.length
+        # approximately per rank
+        return self.length // self.world_size
+
+
+class MsgPackMapDatasetMultiTargetWithDynLabels(
+    _MsgPackSampleMixin, torch.utils.data.Dataset
+):
+    """
+    Data source: bunch of msgpack files with an index (see classification/shard_index.py)
+    Random access to single records, restricted to the images of the target mapping
+    (id->[target1, target, ...]) either as dict or memory-mapped LabelMapping, or to
+    the images with target values in the shard labels (embedded_labels)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        target_mapping: Union[Dict[str, int], LabelMapping, None],
+        key_img_id: str = "id",
+        key_img_encoded: str = "image",
+        transformation=None,
+        meta_path=None,
+        lat_key="LAT",
+        lon_key="LON",
+        jpeg_draft=False,
+        embedded_labels=False,
+        mmap_shards=False,
+    ):
+
+        super(MsgPackMapDatasetMultiTargetWithDynLabels, self).__init__()
+        self._init_samples(
+            target_mapping,
+            key_img_id,
+            key_img_encoded,
+            transformation,
+            meta_path,
+            lat_key,
+            lon_key,
+            jpeg_draft,
+            embedded_labels,
+            mmap_shards,
+        )
+        self.shards = list_shards(path)
+
+        # shard and location of all records with a target value
+        records = []
+        for i, shard in enumerate(self.shards):
+            if not shard_index_path(shard["shard_path"]).exists():
+                raise ValueError(f"No index of {shard['shard_path']}")
+            records.append(self._shard_records(shard["shard_path"], i))
+        self.records = np.concatenate(records)
+        if len(self.records) == 0:
+            raise ValueError("No samples found.")
+
+        # file descriptors or memoryviews (mmap_shards) of the shards, opened on first
+        # access
+        self._fds = {}
+        self._views = {}
+
+    def _read_record(self, idx) -> dict:
+        record = self.records[idx]
+        shard, offset, length = (
+            int(record["shard"]),
+            int(record["offset"]),
+            int(record["length"]),
+        )
+        if self.mmap_shards:
+            if shard not in self._views:
+                mm = map_shard(self.shards[shard]["shard_path"])
+                self._views[shard] = memoryview(mm)
+            return unpack_view(
+                self._views[shard][offset : offset + length], (self.key_img_encoded,)
+            )
+        if shard not in self._fds:
+            self._fds[shard] = os.open(self.shards[shard]["shard_path"], os.O_RDONLY)
+        # positional read, i.e. safe for descriptors shared with forked workers
+        data = os.pread(self._fds[shard], length, offset)
+        return msgpack.unpackb(data, raw=True)
+
+    def __getitem__(self, idx):
+        x = self._read_record(idx)
+        if self.embedded_labels:
+            x["target"] = self._unpack_target(self.records["targets"][idx].tolist())
+            x["lat_lng"] = self.records["lat_lng"][idx]
+        else:
+            x["target"] = self._target(x[self.key_img_id].decode("utf-8"))
+        return self._process_sample(x)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        # descriptors and mappings are not transferable to spawned workers
+        state = self.__dict__.copy()
+        state["_fds"] = {}
+        state["_views"] = {}
+        return state
+
+    def __del__(self):
+        for fd in getattr(self, "_fds", {}).values():
+            os.close(fd)
 
 
 class FiveCropImageDataset(torch.utils.data.Dataset):
@@ -190,12 +943,14 @@ class FiveCropImageDataset(torch.utils.data.Dataset):
         meta_csv: Union[str, Path, None],
         image_dir: Union[str, Path],
         img_id_col: Union[str, int] = "img_id",
-        allowed_extensions: List[str] = ["jpg", "jpeg", "png"]
+        allowed_extensions: List[str] = ["jpg", "jpeg", "png"],
+        jpeg_draft: bool = False,
     ):
         if isinstance(image_dir, str):
             image_dir = Path(image_dir)
         self.image_dir = image_dir
         self.img_id_col = img_id_col
+        self.jpeg_draft = jpeg_draft
         self.meta_info = None
         if meta_csv is not None:
             print(f"Read {meta_csv}")
@@ -234,7 +989,7 @@ class FiveCropImageDataset(torch.utils.data.Dataset):
         meta = meta.to_dict()
         meta["img_id"] = meta[self.img_id_col]
 
-        image = Image.open(meta["img_path"]).convert("RGB")
+        image = open_image(meta["img_path"], (256, 256) if self.jpeg_draft else None)
         image = torchvision.transforms.Resize(256)(image)
         crops = torchvision.transforms.FiveCrop(224)(image)
         crops_transformed = []
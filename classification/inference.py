@@ -35,7 +35,19 @@ def parse_args():
         action="store_true",
         help="Use GPU for inference if CUDA is available",
     )
+    args.add_argument(
+        "--jpeg_draft",
+        action="store_true",
+        help="Decode JPEGs at reduced scale (faster, slightly different pixels)",
+    )
     args.add_argument("--batch_size", type=int, default=64)
+    args.add_argument(
+        "--topk_coarse",
+        type=int,
+        default=None,
+        help="Evaluate finer partitionings only below the k most likely coarse cells "
+        "(see classification/benchmark_pruning.py for speed and agreement)",
+    )
     args.add_argument(
         "--num_workers",
         type=int,
@@ -59,7 +71,9 @@ if args.gpu and torch.cuda.is_available():
 
 print("Init dataloader")
 dataloader = torch.utils.data.DataLoader(
-    FiveCropImageDataset(meta_csv=None, image_dir=args.image_dir),
+    FiveCropImageDataset(
+        meta_csv=None, image_dir=args.image_dir, jpeg_draft=args.jpeg_draft
+    ),
     batch_size=ceil(args.batch_size / 5),
     shuffle=False,
     num_workers=args.num_workers,
@@ -72,7 +86,9 @@ rows = []
 for X in tqdm(dataloader):
     if args.gpu:
         X[0] = X[0].cuda()
-    img_paths, pred_classes, pred_latitudes, pred_longitudes = model.inference(X)
+    img_paths, pred_classes, pred_latitudes, pred_longitudes = model.inference(
+        X, topk_coarse=args.topk_coarse
+    )
     for p_key in pred_classes.keys():
         for img_path, pred_class, pred_lat, pred_lng in zip(
             img_paths,
@@ -0,0 +1,116 @@
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Union
+
+import numpy as np
+
+
+def hash_img_id(img_id: Union[str, bytes]) -> int:
+    """Stable 64-bit hash of an image id"""
+    if isinstance(img_id, str):
+        img_id = img_id.encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(img_id, digest_size=8).digest(), "little")
+
+
+def hash_img_ids(img_ids: Iterable[Union[str, bytes]]) -> np.ndarray:
+    return np.fromiter((hash_img_id(x) for x in img_ids), dtype=np.uint64)
+
+
+class LabelMapping:
+    """Mapping image id -> [target_1, ..., target_n] for n partitionings.
+
+    Stored as a single .npy file of records (id hash, int32 targets) sorted by id hash,
+    which is memory-mapped on load. Therefore, loading is independent of the dataset
+    size and all DataLoader workers share the same pages instead of copying a dict.
+    """
+
+    def __init__(self, data: np.ndarray):
+        self._data = data
+        self.id_hashes = data["id_hash"]
+        self.targets = data["targets"]
+
+    @classmethod
+    def from_arrays(cls, img_ids: Iterable[Union[str, bytes]], targets: np.ndarray):
+        targets = np.asarray(targets, dtype=np.int32)
+        if targets.ndim == 1:
+            targets = targets[:, np.newaxis]
+        id_hashes = hash_img_ids(img_ids)
+        if len(id_hashes) != len(targets):
+            raise ValueError("number of image ids and targets differ")
+
+        order = np.argsort(id_hashes)
+        id_hashes = id_hashes[order]
+        if np.any(id_hashes[1:] == id_hashes[:-1]):
+            raise ValueError("duplicate image ids or hash collision")
+
+        data = np.empty(
+            len(id_hashes),
+            dtype=[("id_hash", "<u8"), ("targets", "<i4", (targets.shape[1],))],
+        )
+        data["id_hash"] = id_hashes
+        data["targets"] = targets[order]
+        return cls(data)
+
+    @classmethod
+    def from_dict(cls, mapping: Dict[str, Union[int, List[int]]]):
+        targets = [v if isinstance(v, list) else [v] for v in mapping.values()]
+        return cls.from_arrays(mapping.keys(), np.array(targets))
+
+    def save(self, path: Union[str, Path]):
+        with open(path, "wb") as f:
+            np.save(f, self._data)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], mmap: bool = True):
+        return cls(np.load(path, mmap_mode="r" if mmap else None))
+
+    def __len__(self):
+        return len(self.id_hashes)
+
+    def index(self, img_id: Union[str, bytes]) -> int:
+        """Row of the given image id or -1 if unknown"""
+        h = np.uint64(hash_img_id(img_id))
+        i = int(np.searchsorted(self.id_hashes, h))
+        if i < len(self.id_hashes) and self.id_hashes[i] == h:
+            return i
+        return -1
+
+    def index_hashes(self, id_hashes: np.ndarray) -> np.ndarray:
+        """Rows of the given image id hashes, -1 for unknown ones"""
+        id_hashes = np.asarray(id_hashes, dtype=np.uint64)
+        if len(self.id_hashes) == 0:
+            return np.full(id_hashes.shape, -1, dtype=np.int64)
+        rows = np.searchsorted(self.id_hashes, id_hashes)
+        rows = np.minimum(rows, len(self.id_hashes) - 1)
+        return np.where(self.id_hashes[rows] == id_hashes, rows, -1)
+
+    def __contains__(self, img_id: Union[str, bytes]) -> bool:
+        return self.index(img_id) >= 0
+
+    def __getitem__(self, img_id: Union[str, bytes]) -> List[int]:
+        i = self.index(img_id)
+        if i < 0:
+            raise KeyError(img_id)
+        return self.targets[i].tolist()
+
+
+def label_mapping_digest(path: Union[str, Path]) -> str:
+    """sha256 of the contents of a label mapping file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_label_mapping(
+    path: Union[str, Path],
+) -> Union[LabelMapping, Dict[str, List[int]]]:
+    """Load the output of partitioning/assign_classes.py, either json (orient=index) or
+    the binary format of LabelMapping
+    """
+    if Path(path).suffix == ".json":
+        with open(path, "r") as f:
+            return json.load(f)
+    return LabelMapping.load(path)
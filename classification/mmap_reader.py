@@ -0,0 +1,175 @@
+import io
+import mmap
+import struct
+from pathlib import Path
+from typing import Container, Iterator, Optional, Tuple, Union
+
+import msgpack
+
+# msgpack type byte -> (size of the length field, fixed payload size) of types with a
+# payload of bytes, see https://github.com/msgpack/msgpack/blob/master/spec.md
+_SIZED = {
+    0xC4: (1, 0),  # bin 8
+    0xC5: (2, 0),  # bin 16
+    0xC6: (4, 0),  # bin 32
+    0xC7: (1, 1),  # ext 8 (+ type)
+    0xC8: (2, 1),  # ext 16
+    0xC9: (4, 1),  # ext 32
+    0xD9: (1, 0),  # str 8
+    0xDA: (2, 0),  # str 16
+    0xDB: (4, 0),  # str 32
+}
+_FIXED = {
+    0xC0: 0,  # nil
+    0xC2: 0,  # false
+    0xC3: 0,  # true
+    0xCA: 4,  # float 32
+    0xCB: 8,  # float 64
+    0xCC: 1,  # uint 8
+    0xCD: 2,
+    0xCE: 4,
+    0xCF: 8,
+    0xD0: 1,  # int 8
+    0xD1: 2,
+    0xD2: 4,
+    0xD3: 8,
+    0xD4: 2,  # fixext 1 (+ type)
+    0xD5: 3,
+    0xD6: 5,
+    0xD7: 9,
+    0xD8: 17,
+}
+_LENGTH_FORMAT = {1: ">B", 2: ">H", 4: ">I"}
+_BIN = (0xC4, 0xC5, 0xC6)
+
+
+def _length(buf: memoryview, pos: int, size: int) -> int:
+    return struct.unpack_from(_LENGTH_FORMAT[size], buf, pos)[0]
+
+
+def _container(buf: memoryview, pos: int):
+    # (number of items, position of the first item) of arrays and maps, None otherwise
+    t = buf[pos]
+    if 0x80 <= t <= 0x8F:
+        return 2 * (t & 0x0F), pos + 1
+    if 0x90 <= t <= 0x9F:
+        return t & 0x0F, pos + 1
+    if t in (0xDC, 0xDE):
+        n = _length(buf, pos + 1, 2)
+        return n * (2 if t == 0xDE else 1), pos + 3
+    if t in (0xDD, 0xDF):
+        n = _length(buf, pos + 1, 4)
+        return n * (2 if t == 0xDF else 1), pos + 5
+    return None
+
+
+def skip_object(buf: memoryview, pos: int = 0) -> int:
+    """End position of the msgpack object starting at pos, without unpacking it"""
+    t = buf[pos]
+    if t <= 0x7F or t >= 0xE0:  # fixint
+        return pos + 1
+    if 0xA0 <= t <= 0xBF:  # fixstr
+        return pos + 1 + (t & 0x1F)
+    if t in _FIXED:
+        return pos + 1 + _FIXED[t]
+    if t in _SIZED:
+        size, extra = _SIZED[t]
+        return pos + 1 + size + extra + _length(buf, pos + 1, size)
+    container = _container(buf, pos)
+    if container is None:
+        raise ValueError(f"Invalid msgpack type 0x{t:02x} at {pos}")
+    n, pos = container
+    for _ in range(n):
+        pos = skip_object(buf, pos)
+    return pos
+
+
+def unpack_view(buf: memoryview, view_keys: Container[bytes] = None) -> dict:
+    """Unpack a msgpack map like msgpack.unpackb(..., raw=True), but binary values
+    (of view_keys, default: all) are memoryview slices of buf instead of copies
+    """
+    if not (0x80 <= buf[0] <= 0x8F or buf[0] in (0xDE, 0xDF)):
+        raise ValueError("Record is not a msgpack map")
+    n, pos = _container(buf, 0)
+    x = {}
+    for _ in range(n // 2):
+        end = skip_object(buf, pos)
+        key = msgpack.unpackb(buf[pos:end], raw=True)
+        pos, end = end, skip_object(buf, end)
+        t = buf[pos]
+        if t in _BIN and (view_keys is None or key in view_keys):
+            size = _SIZED[t][0]
+            x[key] = buf[pos + 1 + size : end]
+        else:
+            x[key] = msgpack.unpackb(buf[pos:end], raw=True)
+        pos = end
+    return x
+
+
+def iter_record_views(buf: memoryview) -> Iterator[Tuple[int, memoryview]]:
+    # (offset, record) of a shard without index, nil records are skipped like
+    # msgpack.Unpacker
+    pos = 0
+    while pos < len(buf):
+        end = skip_object(buf, pos)
+        if buf[pos] != 0xC0:
+            yield pos, buf[pos:end]
+        pos = end
+
+
+def map_shard(shard_path: Union[str, Path]) -> Optional[mmap.mmap]:
+    """Read-only memory map of a shard, None for empty shards.
+    The mapping stays valid as long as memoryviews of it exist.
+    """
+    with open(shard_path, "rb") as f:
+        if f.seek(0, io.SEEK_END) == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def will_need(mm: mmap.mmap, start: int, end: int):
+    # ask the kernel to read [start, end) of a mapping asynchronously (Linux only)
+    if not hasattr(mm, "madvise") or not hasattr(mmap, "MADV_WILLNEED"):
+        return
+    start -= start % mmap.PAGESIZE
+    mm.madvise(mmap.MADV_WILLNEED, start, end - start)
+
+
+class MemoryviewReader(io.RawIOBase):
+    """Read-only file object of a memoryview, e.g. for PIL.Image.open.
+    Unlike io.BytesIO, the memoryview is not copied as a whole.
+    """
+
+    def __init__(self, buf: memoryview):
+        super().__init__()
+        self._buf = buf
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._buf)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def read(self, size=-1):
+        end = len(self._buf) if size is None or size < 0 else self._pos + size
+        data = self._buf[self._pos : end].tobytes()
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self._buf[self._pos : self._pos + len(b)]
+        b[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
@@ -0,0 +1,117 @@
+import os
+import logging
+import shutil
+from argparse import ArgumentParser
+from functools import partial
+from io import BytesIO
+from multiprocessing import Pool
+from pathlib import Path
+
+import msgpack
+
+from classification.dataset import open_image, initial_resize, img_shape_key
+from classification.shard_index import (
+    list_shards,
+    shard_labels_path,
+    shard_labels_source_path,
+    write_shard_index,
+)
+
+
+def repack_record(x: dict, key_img_encoded: bytes, size: int, fmt: str, quality: int):
+    # deterministic first step of the msgpack datasets, done once
+    img = initial_resize(open_image(BytesIO(x[key_img_encoded])), size)
+    if fmt == "raw":
+        x[key_img_encoded] = img.tobytes()
+        x[img_shape_key(key_img_encoded)] = [img.height, img.width, 3]
+    else:
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=quality)
+        x[key_img_encoded] = buffer.getvalue()
+    return x
+
+
+def repack_shard(shard, output_dir, key_img_id, key_img_encoded, size, fmt, quality):
+    key_img_encoded = key_img_encoded.encode("utf-8")
+    out_path = os.path.join(output_dir, os.path.basename(shard["shard_path"]))
+    num_records = 0
+    with open(shard["shard_path"], "rb") as f_in, open(out_path, "wb") as f_out:
+        unpacker = msgpack.Unpacker(f_in, max_buffer_size=1024 * 1024 * 1024, raw=True)
+        packer = msgpack.Packer(use_bin_type=True)
+        for x in unpacker:
+            if x is None:
+                continue
+            x = repack_record(x, key_img_encoded, size, fmt, quality)
+            f_out.write(packer.pack(x))
+            num_records += 1
+    write_shard_index(out_path, key_img_id)
+    # records keep their order, i.e. embedded labels are still aligned
+    if shard_labels_path(shard["shard_path"]).exists():
+        shutil.copyfile(
+            shard_labels_path(shard["shard_path"]), shard_labels_path(out_path)
+        )
+    if shard_labels_source_path(shard["shard_path"]).exists():
+        shutil.copyfile(
+            shard_labels_source_path(shard["shard_path"]),
+            shard_labels_source_path(out_path),
+        )
+    return num_records
+
+
+def parse_args():
+    args = ArgumentParser(
+        description="Repack msgpack shards with images resized to the short side used by "
+        "the datasets, either as JPEG or as raw uint8 arrays (no decoding during "
+        "training, but several times larger)"
+    )
+    args.add_argument(
+        "--input", type=Path, required=True, help="Directory of shard_N.msg files"
+    )
+    args.add_argument(
+        "--output", type=Path, required=True, help="Directory of the new shards"
+    )
+    args.add_argument("--format", choices=["jpeg", "raw"], default="jpeg")
+    args.add_argument(
+        "--quality",
+        type=int,
+        default=90,
+        help="JPEG quality of re-encoded images, i.e. image quality vs. shard size",
+    )
+    args.add_argument(
+        "--size",
+        type=int,
+        default=320,
+        help="Short side of images larger than size on both sides",
+    )
+    args.add_argument("--key_img_id", type=str, default="id")
+    args.add_argument("--key_img_encoded", type=str, default="image")
+    args.add_argument("--num_workers", type=int, default=os.cpu_count())
+    return args.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    shards = list_shards(args.input)
+    logging.info(f"Repack {len(shards)} shards to {args.output} ({args.format})")
+
+    worker = partial(
+        repack_shard,
+        output_dir=args.output,
+        key_img_id=args.key_img_id,
+        key_img_encoded=args.key_img_encoded,
+        size=args.size,
+        fmt=args.format,
+        quality=args.quality,
+    )
+    num_records = 0
+    with Pool(args.num_workers) as p:
+        for i, n in enumerate(p.imap_unordered(worker, shards), start=1):
+            num_records += n
+            logging.info(f"{i}/{len(shards)} shards - {num_records} records")
+
+
+if __name__ == "__main__":
+    main()
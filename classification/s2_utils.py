@@ -1,10 +1,195 @@
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
+import hashlib
 import logging
+import os
 
 import numpy as np
 import pandas as pd
-import s2sphere as s2
+
+
+# S2 cell id layout: 3 face bits, 2 bits per level and a trailing 1 bit
+S2_MAX_LEVEL = 30
+S2_POS_BITS = 2 * S2_MAX_LEVEL + 1
+S2_MAX_SIZE = 1 << S2_MAX_LEVEL
+
+_LOOKUP_BITS = 4
+_SWAP_MASK = 0x01
+_INVERT_MASK = 0x02
+_POS_TO_IJ = ((0, 1, 3, 2), (0, 2, 3, 1), (3, 2, 0, 1), (3, 1, 0, 2))
+_POS_TO_ORIENTATION = (_SWAP_MASK, 0, 0, _INVERT_MASK | _SWAP_MASK)
+
+
+def _init_lookup_pos():
+    # (i, j, orientation) -> (hilbert position, orientation) for 4 bits of i and j,
+    # identical to the LOOKUP_POS table of s2sphere
+    lookup = np.zeros(1 << (2 * _LOOKUP_BITS + 2), dtype=np.uint64)
+
+    def _init_cell(level, i, j, orig_orientation, pos, orientation):
+        if level == _LOOKUP_BITS:
+            ij = (i << _LOOKUP_BITS) + j
+            lookup[(ij << 2) + orig_orientation] = (pos << 2) + orientation
+            return
+        r = _POS_TO_IJ[orientation]
+        for index in range(4):
+            _init_cell(
+                level + 1,
+                (i << 1) + (r[index] >> 1),
+                (j << 1) + (r[index] & 1),
+                orig_orientation,
+                (pos << 2) + index,
+                orientation ^ _POS_TO_ORIENTATION[index],
+            )
+
+    for orientation in range(4):
+        _init_cell(0, 0, 0, orientation, 0, orientation)
+    return lookup
+
+
+_LOOKUP_POS = _init_lookup_pos()
+
+
+def _uv_to_st(u):
+    # quadratic projection, written with |u| so that both branches are finite
+    s = 0.5 * np.sqrt(1 + 3 * np.abs(u))
+    return np.where(u >= 0, s, 1 - s)
+
+
+def _st_to_ij(s):
+    ij = np.floor(S2_MAX_SIZE * s)
+    return np.clip(ij, 0, S2_MAX_SIZE - 1).astype(np.uint64)
+
+
+def latlng_to_cell_id(lat, lng) -> np.ndarray:
+    """Vectorized equivalent of s2.CellId.from_lat_lng(s2.LatLng.from_degrees(lat, lng)).id()
+
+    Returns the 64-bit leaf cell ids (level 30) of all given coordinates as uint64 array.
+    """
+    phi = np.radians(np.asarray(lat, dtype=np.float64))
+    theta = np.radians(np.asarray(lng, dtype=np.float64))
+
+    # lat/lng -> point on the unit sphere
+    cosphi = np.cos(phi)
+    xyz = np.stack([np.cos(theta) * cosphi, np.sin(theta) * cosphi, np.sin(phi)])
+
+    # point -> cube face given by the largest absolute component
+    x_abs, y_abs, z_abs = np.abs(xyz)
+    face = np.where(
+        x_abs > y_abs, np.where(x_abs > z_abs, 0, 2), np.where(y_abs > z_abs, 1, 2)
+    )
+    face = face + 3 * (np.take_along_axis(xyz, face[np.newaxis], axis=0)[0] < 0)
+
+    # face, point -> (u, v), same operand order as s2sphere.valid_face_xyz_to_uv
+    x, y, z = xyz
+    u_num = np.choose(face, [y, -x, -x, z, z, -y])
+    v_num = np.choose(face, [z, z, -y, y, -x, -x])
+    denom = np.choose(face, [x, y, z, x, y, z])
+    u = u_num / denom
+    v = v_num / denom
+
+    i = _st_to_ij(_uv_to_st(u))
+    j = _st_to_ij(_uv_to_st(v))
+
+    # (face, i, j) -> position along the hilbert curve, 4 bits of i and j at a time
+    n = face.astype(np.uint64) << np.uint64(S2_POS_BITS - 1)
+    bits = (face & _SWAP_MASK).astype(np.uint64)
+    mask = np.uint64((1 << _LOOKUP_BITS) - 1)
+    for k in range(7, -1, -1):
+        shift = np.uint64(k * _LOOKUP_BITS)
+        bits = bits + (((i >> shift) & mask) << np.uint64(_LOOKUP_BITS + 2))
+        bits = bits + (((j >> shift) & mask) << np.uint64(2))
+        bits = _LOOKUP_POS[bits]
+        n |= (bits >> np.uint64(2)) << np.uint64(k * 2 * _LOOKUP_BITS)
+        bits &= np.uint64(_SWAP_MASK | _INVERT_MASK)
+
+    return n * np.uint64(2) + np.uint64(1)
+
+
+def cell_id_lsb(cell_ids) -> np.ndarray:
+    cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+    return cell_ids & (~cell_ids + np.uint64(1))
+
+
+def cell_id_lsb_for_level(level) -> np.ndarray:
+    level = np.asarray(level, dtype=np.uint64)
+    return np.uint64(1) << (np.uint64(2) * (np.uint64(S2_MAX_LEVEL) - level))
+
+
+def cell_id_level(cell_ids) -> np.ndarray:
+    # the lsb is a power of two and therefore exactly representable as float
+    trailing_zeros = np.log2(cell_id_lsb(cell_ids).astype(np.float64)).astype(np.int64)
+    return S2_MAX_LEVEL - trailing_zeros // 2
+
+
+def cell_id_parent(cell_ids, level) -> np.ndarray:
+    """Vectorized equivalent of s2.CellId(cell_id).parent(level).id()"""
+    cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+    lsb = cell_id_lsb_for_level(level)
+    return (cell_ids & ~(lsb - np.uint64(1))) | lsb
+
+
+def cell_id_children(cell_ids) -> np.ndarray:
+    """The four children of each cell, one level below, as array of shape [n, 4]"""
+    cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+    child_lsb = cell_id_lsb(cell_ids) >> np.uint64(2)
+    first_child = cell_ids - np.uint64(3) * child_lsb
+    offsets = np.arange(4, dtype=np.uint64) * np.uint64(2)
+    return first_child[:, np.newaxis] + offsets * child_lsb[:, np.newaxis]
+
+
+def cell_id_range_min(cell_ids) -> np.ndarray:
+    cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+    return cell_ids - (cell_id_lsb(cell_ids) - np.uint64(1))
+
+
+def cell_id_range_max(cell_ids) -> np.ndarray:
+    cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+    return cell_ids + (cell_id_lsb(cell_ids) - np.uint64(1))
+
+
+def cell_id_to_token(cell_ids) -> List[str]:
+    """Hex tokens as created by s2.CellId.to_token()"""
+    return [format(int(c), "016x").rstrip("0") for c in np.asarray(cell_ids).ravel()]
+
+
+def token_to_cell_id(tokens) -> np.ndarray:
+    """Inverse of cell_id_to_token, i.e. s2.CellId.from_token(token).id()"""
+    return np.array([int(t.ljust(16, "0"), 16) for t in tokens], dtype=np.uint64)
+
+
+class CellIndex:
+    """Sorted interval index over disjoint S2 cells, i.e. all cells of a partitioning.
+
+    Each cell covers the leaf cell ids [range_min, range_max], so the cell containing a
+    given cell id is found with a single binary search.
+    """
+
+    def __init__(self, cell_ids, values):
+        cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+        order = np.argsort(cell_ids)
+        self.range_min = cell_id_range_min(cell_ids[order])
+        self.range_max = cell_id_range_max(cell_ids[order])
+        self.values = np.asarray(values)[order]
+        if np.any(self.range_min[1:] <= self.range_max[:-1]):
+            raise ValueError("cells of a CellIndex must not overlap")
+
+    @classmethod
+    def from_tokens(cls, tokens, values):
+        return cls(token_to_cell_id(tokens), values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def lookup(self, cell_ids, missing=-1) -> np.ndarray:
+        """Value of the cell containing each cell id or missing if there is none"""
+        cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+        if len(self) == 0:
+            return np.full(cell_ids.shape, missing)
+        idx = np.searchsorted(self.range_min, cell_ids, side="right") - 1
+        found = idx >= 0
+        idx = np.maximum(idx, 0)
+        found &= cell_ids <= self.range_max[idx]
+        return np.where(found, self.values[idx], missing)
 
 
 def print_partitioning_stats(partitionings):
@@ -12,8 +197,7 @@ def print_partitioning_stats(partitionings):
     unique_classes = set()
     for p in partitionings:
         logging.info(f"{p.shortname} - Number of classes: {len(p)}")
-        classes = p._df[p._col_class_label].tolist()
-        unique_classes = unique_classes.union(classes)
+        unique_classes = unique_classes.union(p.class_labels.tolist())
     logging.info(f"Unique classes: {len(unique_classes)}")
 
 
@@ -37,20 +221,36 @@ class Partitioning:
         """
 
         logging.info(f"Loading partitioning from file: {csv_file}")
-        self._df = pd.read_csv(csv_file, index_col=index_col, skiprows=skiprows)
-        self._df = self._df.sort_index()
+        df = pd.read_csv(csv_file, index_col=index_col, skiprows=skiprows)
+        df = df.sort_index()
 
-        self._nclasses = len(self._df.index)
-        self._col_class_label = col_class_label
-        self._col_latitude = col_latitute
-        self._col_longitude = col_longitude
+        self._init_arrays(
+            csv_file.stem,  # filename without extension
+            shortname,
+            df[col_class_label].to_numpy(),
+            df[[col_latitute, col_longitude]].to_numpy(dtype=np.float64),
+        )
+
+    @classmethod
+    def from_arrays(cls, name, class_labels, lat_lng, cell_ids=None, shortname=None):
+        """Partitioning from arrays ordered by class index, e.g. of compiled partitionings"""
+        partitioning = cls.__new__(cls)
+        partitioning._init_arrays(name, shortname, class_labels, lat_lng, cell_ids)
+        return partitioning
+
+    def _init_arrays(self, name, shortname, class_labels, lat_lng, cell_ids=None):
+        self._nclasses = len(class_labels)
+        # per class index: class label (hexid), S2 cell id and centroid [lat, lng]
+        self.class_labels = np.asarray(class_labels)
+        if cell_ids is None:
+            cell_ids = token_to_cell_id(self.class_labels)
+        self.cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+        self.lat_lng = np.ascontiguousarray(lat_lng, dtype=np.float64)
 
         # map class label (hexid) to index
-        self._label2index = dict(
-            zip(self._df[self._col_class_label].tolist(), list(self._df.index))
-        )
+        self._label2index = dict(zip(self.class_labels.tolist(), range(self._nclasses)))
 
-        self.name = csv_file.stem  # filename without extension
+        self.name = name
         if shortname:
             self.shortname = shortname
         else:
@@ -63,11 +263,15 @@ class Partitioning:
         return f"{self.name} short: {self.shortname} n: {self._nclasses}"
 
     def get_class_label(self, idx):
-        return self._df.iloc[idx][self._col_class_label]
+        return self.class_labels[idx]
 
     def get_lat_lng(self, idx):
-        x = self._df.iloc[idx]
-        return float(x[self._col_latitude]), float(x[self._col_longitude])
+        lat, lng = self.lat_lng[idx]
+        return float(lat), float(lng)
+
+    def get_lat_lngs(self, indexes) -> np.ndarray:
+        """Centroids [n, 2] of n class indexes"""
+        return self.lat_lng[indexes]
 
     def contains(self, class_label):
         if class_label in self._label2index:
@@ -82,67 +286,121 @@ class Partitioning:
 
 
 class Hierarchy:
-    def __init__(self, partitionings: List[Partitioning]):
+    def __init__(self, partitionings: List[Partitioning], M: np.ndarray = None):
 
         """
         Provide a matrix of class indices where each class of the finest partitioning will be assigned
         to the next coarser scales.
 
         Resulting index matrix M has shape: max(classes) * |partitionings| and is ordered from coarse to fine
+        An already computed M, e.g. of compiled partitionings, is used as is.
         """
         self.partitionings = partitionings
 
         print_partitioning_stats(self.partitionings)
 
-        self.M = self.__build_hierarchy()
+        if M is None:
+            M = self.__build_hierarchy()
+        self.M = M
 
     def __build_hierarchy(self):
-        def _hextobin(hexval):
-            thelen = len(hexval) * 4
-            binval = bin(int(hexval, 16))[2:]
-            while (len(binval)) < thelen:
-                binval = "0" + binval
+        # ancestor of each class of the finest partitioning in every partitioning,
+        # found by exact lookups of the parent cell ids on each level
+        finest_ids = self.partitionings[-1].cell_ids
+        finest_levels = cell_id_level(finest_ids)
 
-            binval = binval.rstrip("0")
-            return binval
-
-        def _create_cell(lat, lng, level):
-            p1 = s2.LatLng.from_degrees(lat, lng)
-            cell = s2.Cell.from_lat_lng(p1)
-            cell_parent = cell.id().parent(level)
-            hexid = cell_parent.to_token()
-            return hexid
-
-        cell_hierarchy = []
-
-        finest_partitioning = self.partitionings[-1]
         logging.info("Create hierarchy from partitionings...")
-        if len(self.partitionings) > 1:
-            # loop through finest partitioning
-            for c in range(len(finest_partitioning)):
-                cell_bin = _hextobin(self.partitionings[-1].get_class_label(c))
-                level = int(len(cell_bin[3:-1]) / 2)
-                parents = []
-
-                # get parent cells
-                for l in reversed(range(2, level + 1)):
-                    lat, lng = finest_partitioning.get_lat_lng(c)
-                    hexid_parent = _create_cell(lat, lng, l)
-                    # to coarsest partitioning
-                    for p in reversed(range(len(self.partitionings))):
-                        if self.partitionings[p].contains(hexid_parent):
-                            parents.append(
-                                self.partitionings[p].label2index(hexid_parent)
-                            )
-
-                    if len(parents) == len(self.partitionings):
-                        break
-
-                cell_hierarchy.append(parents[::-1])
+        M = np.full((len(finest_ids), len(self.partitionings)), -1, dtype=np.int32)
+        for i, partitioning in enumerate(self.partitionings):
+            order = np.argsort(partitioning.cell_ids)
+            cell_ids = partitioning.cell_ids[order]
+            for level in np.unique(cell_id_level(cell_ids)):
+                rows = np.flatnonzero(finest_levels >= level)
+                parents = cell_id_parent(finest_ids[rows], level)
+                pos = np.minimum(np.searchsorted(cell_ids, parents), len(cell_ids) - 1)
+                found = cell_ids[pos] == parents
+                M[rows[found], i] = order[pos[found]]
+
+            missing = np.count_nonzero(M[:, i] < 0)
+            if missing > 0:
+                raise ValueError(
+                    f"{missing} classes of {self.partitionings[-1]} have no parent "
+                    f"cell in {partitioning}"
+                )
         logging.info("Finished.")
-        M = np.array(cell_hierarchy, dtype=np.int32)
-        assert max([len(p) for p in self.partitionings]) == M.shape[0]
-        assert len(self.partitionings) == M.shape[1]
         logging.debug(M)
         logging.info(f"M={M.shape}")
         return M
+
+
+def partitionings_digest(
+    csv_files: List[Union[str, Path]], shortnames: List[str]
+) -> str:
+    """sha256 of the contents of the partitioning files and their shortnames"""
+    digest = hashlib.sha256()
+    for csv_file, shortname in zip(csv_files, shortnames):
+        with open(csv_file, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+        digest.update(hashlib.sha256(str(shortname).encode("utf-8")).digest())
+    return digest.hexdigest()
+
+
+def compile_partitionings(
+    partitionings: List[Partitioning], M: Optional[np.ndarray], digest: str
+) -> Dict[str, np.ndarray]:
+    """Arrays of all partitionings and their hierarchy, see load_compiled_partitionings"""
+    compiled = {
+        "digest": np.array(digest),
+        "names": np.array([p.name for p in partitionings]),
+        "shortnames": np.array([p.shortname for p in partitionings]),
+    }
+    if M is not None:
+        compiled["M"] = M
+    for i, p in enumerate(partitionings):
+        compiled[f"class_labels_{i}"] = p.class_labels.astype(str)
+        compiled[f"cell_ids_{i}"] = p.cell_ids
+        compiled[f"lat_lng_{i}"] = p.lat_lng
+    return compiled
+
+
+def load_compiled_partitionings(
+    compiled: Dict[str, np.ndarray], digest: str = None
+) -> Tuple[List[Partitioning], Optional[np.ndarray]]:
+    """Partitionings and hierarchy M (None for a single partitioning) of
+    compile_partitionings. Raises a ValueError if the digest of the source files differs.
+    """
+    if digest is not None and str(compiled["digest"]) != digest:
+        raise ValueError("compiled partitionings do not match the partitioning files")
+
+    partitionings = [
+        Partitioning.from_arrays(
+            str(name),
+            compiled[f"class_labels_{i}"],
+            compiled[f"lat_lng_{i}"],
+            compiled[f"cell_ids_{i}"],
+            shortname=str(shortname),
+        )
+        for i, (name, shortname) in enumerate(
+            zip(compiled["names"], compiled["shortnames"])
+        )
+    ]
+    return partitionings, compiled.get("M")
+
+
+def save_compiled_partitionings(
+    path: Union[str, Path], compiled: Dict[str, np.ndarray]
+):
+    # readers (e.g. other DDP ranks) see either the old or the complete new file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **compiled)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_compiled_partitionings(path: Union[str, Path]) -> Dict[str, np.ndarray]:
+    with np.load(path) as f:
+        return dict(f)
@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import logging
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+import msgpack
+
+from classification.label_mapping import (
+    LabelMapping,
+    hash_img_ids,
+    label_mapping_digest,
+    load_label_mapping,
+)
+
+SHARD_RE = r"shard_(\d+).msg"
+
+
+def list_shards(path: Union[str, Path, List[Union[str, Path]]]) -> list:
+    """All shard_N.msg files of one or multiple directories"""
+    if not isinstance(path, (list, set, tuple)):
+        path = [path]
+    shards = []
+    for i, p in enumerate(path):
+        shards_index = [
+            int(re.match(SHARD_RE, x).group(1))
+            for x in os.listdir(p)
+            if re.match(SHARD_RE, x)
+        ]
+        shards.extend(
+            [
+                {
+                    "path_index": i,
+                    "path": p,
+                    "shard_index": s,
+                    "shard_path": os.path.join(p, f"shard_{s}.msg"),
+                }
+                for s in shards_index
+            ]
+        )
+    if len(shards) == 0:
+        raise ValueError("No shards found")
+    return shards
+
+
+def shard_index_path(shard_path: Union[str, Path]) -> Path:
+    # shard_N.msg -> shard_N.idx.npy
+    return Path(shard_path).with_suffix(".idx.npy")
+
+
+def shard_labels_path(shard_path: Union[str, Path]) -> Path:
+    # shard_N.msg -> shard_N.labels.npy
+    return Path(shard_path).with_suffix(".labels.npy")
+
+
+def shard_labels_source_path(shard_path: Union[str, Path]) -> Path:
+    # shard_N.msg -> shard_N.labels.json
+    return Path(shard_path).with_suffix(".labels.json")
+
+
+def index_shard(shard_path: Union[str, Path], key_img_id: str = "id") -> np.ndarray:
+    """Byte offset, length, image id and its hash (see label_mapping.hash_img_id) of
+    all records of a shard, in file order
+    """
+    key_img_id = key_img_id.encode("utf-8")
+    offsets, lengths, ids = [], [], []
+    with open(shard_path, "rb") as f:
+        unpacker = msgpack.Unpacker(f, max_buffer_size=1024 * 1024 * 1024, raw=True)
+        offset = 0
+        for x in unpacker:
+            end = unpacker.tell()
+            if x is not None:
+                offsets.append(offset)
+                lengths.append(end - offset)
+                ids.append(x[key_img_id])
+            offset = end
+
+    index = np.empty(
+        len(ids),
+        dtype=[
+            ("offset", "<u8"),
+            ("length", "<u8"),
+            ("id_hash", "<u8"),
+            ("id", f"S{max(map(len, ids), default=1)}"),
+        ],
+    )
+    index["offset"] = offsets
+    index["length"] = lengths
+    index["id_hash"] = hash_img_ids(ids)
+    index["id"] = ids
+    return index
+
+
+def load_shard_index(shard_path: Union[str, Path], mmap: bool = True) -> np.ndarray:
+    """Load the index of a shard created by write_shard_index.
+    Raises a ValueError if the shard was changed afterwards.
+    """
+    index = np.load(shard_index_path(shard_path), mmap_mode="r" if mmap else None)
+    end = int(index["offset"][-1] + index["length"][-1]) if len(index) > 0 else 0
+    if end > os.path.getsize(shard_path):
+        raise ValueError(f"Index of {shard_path} does not match the shard")
+    return index
+
+
+def write_shard_index(shard_path: Union[str, Path], key_img_id: str = "id") -> int:
+    index = index_shard(shard_path, key_img_id)
+    with open(shard_index_path(shard_path), "wb") as f:
+        np.save(f, index)
+    return len(index)
+
+
+def shard_labels(
+    index: np.ndarray,
+    target_mapping: Union[Dict[str, List[int]], LabelMapping],
+    meta: pd.DataFrame = None,
+    lat_key: str = "LAT",
+    lon_key: str = "LON",
+) -> np.ndarray:
+    """Targets (-1 if not part of the mapping) and [lat, lng] (NaN if unknown) of all
+    records of a shard index, in the same order
+    """
+    if isinstance(target_mapping, LabelMapping):
+        rows = target_mapping.index_hashes(index["id_hash"])
+        targets = target_mapping.targets[np.maximum(rows, 0)]
+        targets = np.where(rows[:, np.newaxis] >= 0, targets, -1)
+    else:
+        ids = [_id.decode("utf-8") for _id in index["id"]]
+        num_targets = len(np.atleast_1d(next(iter(target_mapping.values()))))
+        targets = np.array(
+            [target_mapping.get(_id, [-1] * num_targets) for _id in ids]
+        ).reshape(len(ids), num_targets)
+
+    labels = np.empty(
+        len(index),
+        dtype=[("targets", "<i4", (targets.shape[1],)), ("lat_lng", "<f4", (2,))],
+    )
+    labels["targets"] = targets
+    labels["lat_lng"] = np.nan
+    if meta is not None:
+        ids = [_id.decode("utf-8") for _id in index["id"]]
+        labels["lat_lng"] = meta.reindex(ids)[[lat_key, lon_key]].to_numpy(
+            dtype=np.float32
+        )
+    return labels
+
+
+def load_shard_labels(shard_path: Union[str, Path], mmap: bool = True) -> np.ndarray:
+    """Load the labels of a shard created by write_shard_labels.
+    Raises a ValueError if they are not aligned with the index of the shard.
+    """
+    labels = np.load(shard_labels_path(shard_path), mmap_mode="r" if mmap else None)
+    if len(labels) != len(load_shard_index(shard_path)):
+        raise ValueError(f"Labels of {shard_path} do not match the shard index")
+    return labels
+
+
+def write_shard_labels(
+    shard_path: Union[str, Path], *args, mapping_digest: str = None, **kwargs
+) -> int:
+    """Write the labels of a shard (see shard_labels) and their source, i.e. the
+    digest of the label mapping file (see label_mapping_digest) and the number of
+    targets, to check them against the configured label mapping before training
+    """
+    labels = shard_labels(load_shard_index(shard_path), *args, **kwargs)
+    with open(shard_labels_path(shard_path), "wb") as f:
+        np.save(f, labels)
+    with open(shard_labels_source_path(shard_path), "w") as f:
+        json.dump(
+            {
+                "label_mapping_digest": mapping_digest,
+                "num_targets": int(labels["targets"].shape[1]),
+            },
+            f,
+        )
+    return int(np.count_nonzero((labels["targets"] >= 0).all(axis=1)))
+
+
+def check_shard_labels(
+    path: Union[str, Path, List[Union[str, Path]]],
+    label_mapping: Union[str, Path],
+    num_targets: int,
+):
+    """Raises a ValueError if the labels of any shard were not embedded from the given
+    label mapping file or have a different number of targets, e.g. after creating new
+    partitionings
+    """
+    digest = label_mapping_digest(label_mapping)
+    for shard in list_shards(path):
+        shard_path = shard["shard_path"]
+        if not shard_labels_source_path(shard_path).exists():
+            raise ValueError(
+                f"Source of the labels of {shard_path} unknown, embed them again"
+            )
+        with open(shard_labels_source_path(shard_path)) as f:
+            source = json.load(f)
+        if source["num_targets"] != num_targets:
+            raise ValueError(
+                f"Labels of {shard_path} have {source['num_targets']} targets, "
+                f"expected {num_targets} (one per partitioning)"
+            )
+        if source["label_mapping_digest"] != digest:
+            raise ValueError(
+                f"Labels of {shard_path} were not embedded from {label_mapping}, "
+                "embed them again"
+            )
+
+
+def _write_shard_index_worker(args):
+    return write_shard_index(*args)
+
+
+def parse_args():
+    args = ArgumentParser(
+        description="Create the index (shard_N.idx.npy) of all msgpack shards and "
+        "optionally embed targets and coordinates (shard_N.labels.npy)"
+    )
+    args.add_argument(
+        "--path",
+        type=Path,
+        nargs="+",
+        required=True,
+        help="Whitespace separated list of directories containing shard_N.msg files",
+    )
+    args.add_argument("--key_img_id", type=str, default="id")
+    args.add_argument(
+        "--overwrite", action="store_true", help="Index shards with an existing index"
+    )
+    args.add_argument("--num_workers", type=int, default=os.cpu_count())
+    args.add_argument(
+        "--label_mapping",
+        type=Path,
+        default=None,
+        help="Store the targets of this label mapping (*.npy or *.json) per record",
+    )
+    args.add_argument(
+        "--meta_path",
+        type=Path,
+        default=None,
+        help="Store the coordinates of this csv (index: image id) per record",
+    )
+    args.add_argument("--lat_key", type=str, default="LAT")
+    args.add_argument("--lon_key", type=str, default="LON")
+    return args.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    shards = [s["shard_path"] for s in list_shards(args.path)]
+    if not args.overwrite:
+        shards = [s for s in shards if not shard_index_path(s).exists()]
+    logging.info(f"Index {len(shards)} shards")
+
+    with Pool(args.num_workers) as p:
+        num_records = p.map(
+            _write_shard_index_worker, [(s, args.key_img_id) for s in shards]
+        )
+    logging.info(f"Indexed {sum(num_records)} records")
+
+    if args.label_mapping is None:
+        return
+    target_mapping = load_label_mapping(args.label_mapping)
+    mapping_digest = label_mapping_digest(args.label_mapping)
+    meta = None
+    if args.meta_path is not None:
+        meta = pd.read_csv(args.meta_path, index_col=0)
+    num_labeled = 0
+    for shard in list_shards(args.path):
+        num_labeled += write_shard_labels(
+            shard["shard_path"],
+            target_mapping,
+            meta,
+            args.lat_key,
+            args.lon_key,
+            mapping_digest=mapping_digest,
+        )
+    logging.info(f"Embedded labels of {num_labeled} records")
+
+
+if __name__ == "__main__":
+    main()
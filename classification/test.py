@@ -53,6 +53,11 @@ def parse_args():
         default=32,
         help="Full precision (32), half precision (16)",
     )
+    args.add_argument(
+        "--jpeg_draft",
+        action="store_true",
+        help="Decode JPEGs at reduced scale (faster, slightly different pixels)",
+    )
     args.add_argument("--batch_size", type=int, default=64)
     args.add_argument(
         "--num_workers",
@@ -80,7 +85,7 @@ trainer = pl.Trainer(gpus=args.gpu, precision=args.precision)
 print("Init Testsets")
 dataloader = []
 for image_dir, meta_csv in zip(args.image_dirs, args.meta_files):
-    dataset = FiveCropImageDataset(meta_csv, image_dir)
+    dataset = FiveCropImageDataset(meta_csv, image_dir, jpeg_draft=args.jpeg_draft)
     dataloader.append(
         torch.utils.data.DataLoader(
             dataset,
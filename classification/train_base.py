@@ -1,8 +1,8 @@
 from argparse import Namespace, ArgumentParser
 from datetime import datetime
-import json
 import logging
 from pathlib import Path
+from zipfile import BadZipFile
 
 import yaml
 import torch
@@ -11,42 +11,196 @@ import pytorch_lightning as pl
 import pandas as pd
 
 from classification import utils_global
-from classification.s2_utils import Partitioning, Hierarchy
-from classification.dataset import MsgPackIterableDatasetMultiTargetWithDynLabels
+from classification.s2_utils import (
+    Partitioning,
+    Hierarchy,
+    partitionings_digest,
+    compile_partitionings,
+    load_compiled_partitionings,
+    save_compiled_partitionings,
+    read_compiled_partitionings,
+)
+from classification.dataset import (
+    MsgPackIterableDatasetMultiTargetWithDynLabels,
+    pil_to_uint8_tensor,
+)
+from classification.label_mapping import load_label_mapping
+from classification.shard_index import check_shard_labels
 
 
 class MultiPartitioningClassifier(pl.LightningModule):
+    # set while load_from_checkpoint creates the model
+    _partitionings_from_checkpoint = False
+
     def __init__(self, hparams: Namespace):
         super().__init__()
         self.hparams = hparams
 
-        self.partitionings, self.hierarchy = self.__init_partitionings()
+        if self._partitionings_from_checkpoint:
+            # partitionings and classifier are created in on_load_checkpoint
+            self.partitionings, self._hierarchy_M = [], None
+            self._partitionings_digest = None
+        else:
+            self.partitionings, self._hierarchy_M = self.__init_partitionings()
+        self._hierarchy = None
         self.model, self.classifier = self.__build_model()
+        self.__register_lat_lngs()
+        self._train_dataset_state = None
+
+        # ImageNet statistics of uint8 pixels to normalize batches of uint8 images
+        self.register_buffer(
+            "pixel_mean",
+            torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1) * 255,
+            persistent=False,
+        )
+        self.register_buffer(
+            "pixel_std",
+            torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1) * 255,
+            persistent=False,
+        )
+
+    @classmethod
+    def load_from_checkpoint(cls, *args, **kwargs):
+        """Load a model with the partitionings embedded in the checkpoint, i.e. without
+        parsing and hashing the partitioning files. Checkpoints without embedded
+        partitionings use the files of the hparams.
+        """
+        cls._partitionings_from_checkpoint = True
+        try:
+            return super().load_from_checkpoint(*args, **kwargs)
+        finally:
+            cls._partitionings_from_checkpoint = False
 
     def __init_partitionings(self):
 
+        files = self.hparams.partitionings["files"]
+        shortnames = self.hparams.partitionings["shortnames"]
+        self._partitionings_digest = partitionings_digest(files, shortnames)
+
+        # optional cache of the parsed partitionings and their hierarchy
+        compiled = self.hparams.partitionings.get("compiled")
+        if compiled is not None and Path(compiled).exists():
+            try:
+                return load_compiled_partitionings(
+                    read_compiled_partitionings(compiled), self._partitionings_digest
+                )
+            except (ValueError, KeyError, EOFError, OSError, BadZipFile) as e:
+                # outdated, incomplete or otherwise unreadable
+                logging.warning(f"{compiled}: {e!r}, compile again")
+
         partitionings = []
-        for shortname, path in zip(
-            self.hparams.partitionings["shortnames"],
-            self.hparams.partitionings["files"],
-        ):
+        for shortname, path in zip(shortnames, files):
             partitionings.append(Partitioning(Path(path), shortname, skiprows=2))
 
-        if len(self.hparams.partitionings["files"]) == 1:
-            return partitionings, None
+        M = None
+        if compiled is not None:
+            if len(partitionings) > 1:
+                M = Hierarchy(partitionings).M
+            logging.info(f"Write compiled partitionings to {compiled}")
+            try:
+                save_compiled_partitionings(
+                    compiled,
+                    compile_partitionings(partitionings, M, self._partitionings_digest),
+                )
+            except OSError as e:
+                # the cache is optional, e.g. a read-only directory
+                logging.warning(f"Can't write {compiled}: {e}")
+        return partitionings, M
+
+    def __register_lat_lngs(self):
+        # class centroids on the model's device, not part of the state dict
+        for i, partitioning in enumerate(self.partitionings):
+            self.register_buffer(
+                f"lat_lng_{i}",
+                torch.from_numpy(partitioning.lat_lng).float(),
+                persistent=False,
+            )
 
-        return partitionings, Hierarchy(partitionings)
+    @property
+    def hierarchy(self):
+        # built on first use, i.e. loading a model does not depend on it
+        if self._hierarchy is None and len(self.partitionings) > 1:
+            self._hierarchy = Hierarchy(self.partitionings, self._hierarchy_M)
+            # M as [partitionings, finest classes] on the model's device
+            index = torch.as_tensor(
+                self._hierarchy.M.T, dtype=torch.long, device=self.lat_lng_0.device
+            ).contiguous()
+            self.register_buffer("hierarchy_index", index, persistent=False)
+            # coarse classes with classes of the finest partitioning and the coarsest
+            # parent of each class (-1: no class of the finest partitioning)
+            has_children = index.new_zeros(len(self.partitionings[0]), dtype=bool)
+            has_children[index[0]] = True
+            self.register_buffer("coarse_has_children", has_children, persistent=False)
+            for i in range(1, len(self.partitionings)):
+                coarse_parent = index.new_full((len(self.partitionings[i]),), -1)
+                coarse_parent[index[i]] = index[0]
+                self.register_buffer(
+                    f"coarse_parent_{i}", coarse_parent, persistent=False
+                )
+        return self._hierarchy
+
+    def hierarchy_scores(self, log_probs):
+        # sum of the log-probabilities of each finest class and its parents,
+        # i.e. log of their product, accumulated per partitioning
+        scores = log_probs[0].index_select(1, self.hierarchy_index[0])
+        for i in range(1, len(log_probs)):
+            scores += log_probs[i].index_select(1, self.hierarchy_index[i])
+        return scores
+
+    def on_save_checkpoint(self, checkpoint):
+        # partitionings and hierarchy the classifier was trained with
+        M = self.hierarchy.M if self.hierarchy is not None else None
+        checkpoint["partitionings"] = compile_partitionings(
+            self.partitionings, M, self._partitionings_digest
+        )
+        # position in the training data to continue an interrupted epoch
+        dataloader = getattr(self.trainer, "train_dataloader", None)
+        if dataloader is not None:
+            checkpoint["train_dataset"] = dataloader.dataset.state_dict()
+
+    def on_load_checkpoint(self, checkpoint):
+        # applied when the next training epoch starts
+        self._train_dataset_state = checkpoint.get("train_dataset")
+        compiled = checkpoint.get("partitionings")
+        if self._partitionings_digest is None:
+            # created by load_from_checkpoint, the weights are loaded afterwards
+            if compiled is None:
+                self.partitionings, self._hierarchy_M = self.__init_partitionings()
+            else:
+                self.partitionings, self._hierarchy_M = load_compiled_partitionings(
+                    compiled
+                )
+                self._partitionings_digest = str(compiled["digest"])
+            self.classifier = self.__build_classifier(self._nfeatures)
+            self.__register_lat_lngs()
+            return
+        if compiled is None:
+            return
+        if str(compiled["digest"]) == self._partitionings_digest:
+            if self._hierarchy_M is None:
+                self._hierarchy_M = compiled.get("M")
+            return
+        # the class indexes of the weights refer to the embedded partitionings
+        partitionings, M = load_compiled_partitionings(compiled)
+        if [len(p) for p in partitionings] != [len(p) for p in self.partitionings]:
+            raise ValueError(
+                "Partitioning files differ from the checkpoint in their number of "
+                "classes, use the files the checkpoint was trained with or "
+                "MultiPartitioningClassifier.load_from_checkpoint"
+            )
+        logging.warning(
+            "Partitioning files differ from the checkpoint, use the partitionings "
+            "stored in the checkpoint"
+        )
+        self.partitionings, self._hierarchy_M = partitionings, M
+        self._hierarchy = None
+        self.__register_lat_lngs()
 
     def __build_model(self):
         logging.info("Build model")
-        model, nfeatures = utils_global.build_base_model(self.hparams.arch)
+        model, self._nfeatures = utils_global.build_base_model(self.hparams.arch)
 
-        classifier = torch.nn.ModuleList(
-            [
-                torch.nn.Linear(nfeatures, len(self.partitionings[i]))
-                for i in range(len(self.partitionings))
-            ]
-        )
+        classifier = self.__build_classifier(self._nfeatures)
 
         if self.hparams.weights:
             logging.info("Load weights from pre-trained model")
@@ -56,13 +210,40 @@ class MultiPartitioningClassifier(pl.LightningModule):
 
         return model, classifier
 
+    def __build_classifier(self, nfeatures):
+        classifier = torch.nn.ModuleList(
+            [
+                torch.nn.Linear(nfeatures, len(self.partitionings[i]))
+                for i in range(len(self.partitionings))
+            ]
+        )
+        return classifier
+
+    def get_lat_lngs(self, partitioning_idx, class_indexes):
+        # batched gather of the predicted centroids
+        lat_lng = getattr(self, f"lat_lng_{partitioning_idx}")[class_indexes]
+        return lat_lng[:, 0], lat_lng[:, 1]
+
     def forward(self, x):
         fv = self.model(x)
         yhats = [self.classifier[i](fv) for i in range(len(self.partitionings))]
         return yhats
 
+    def normalize_images(self, images, flip=False):
+        """Normalized float images of a batch of uint8 images (uint8_loader), flipped
+        horizontally at random per image if flip. Float images are returned unchanged.
+        """
+        if images.dtype != torch.uint8:
+            return images
+        images = images.float()
+        if flip:
+            flipped = torch.rand(images.shape[0], device=images.device) < 0.5
+            images = torch.where(flipped.view(-1, 1, 1, 1), images.flip(3), images)
+        return (images - self.pixel_mean) / self.pixel_std
+
     def training_step(self, batch, batch_idx, optimizer_idx=None):
         images, target = batch
+        images = self.normalize_images(images, flip=True)
 
         if not isinstance(target, list) and len(target.shape) == 1:
             target = [target]
@@ -90,6 +271,7 @@ class MultiPartitioningClassifier(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         images, target, true_lats, true_lngs = batch
+        images = self.normalize_images(images)
 
         if not isinstance(target, list) and len(target.shape) == 1:
             target = [target]
@@ -119,11 +301,9 @@ class MultiPartitioningClassifier(pl.LightningModule):
         distances_dict = {}
 
         if self.hierarchy is not None:
-            hierarchy_logits = [
-                yhat[:, self.hierarchy.M[:, i]] for i, yhat in enumerate(output)
-            ]
-            hierarchy_logits = torch.stack(hierarchy_logits, dim=-1,)
-            hierarchy_preds = torch.prod(hierarchy_logits, dim=-1)
+            hierarchy_preds = self.hierarchy_scores(
+                [torch.nn.functional.log_softmax(yhat, dim=1) for yhat in output]
+            )
 
         pnames = [p.shortname for p in self.partitionings]
         if self.hierarchy is not None:
@@ -135,13 +315,7 @@ class MultiPartitioningClassifier(pl.LightningModule):
                 pred_class_indexes = torch.argmax(hierarchy_preds, dim=1)
             else:
                 pred_class_indexes = torch.argmax(output[i], dim=1)
-            pred_latlngs = [
-                self.partitionings[i].get_lat_lng(idx)
-                for idx in pred_class_indexes.tolist()
-            ]
-            pred_lats, pred_lngs = map(list, zip(*pred_latlngs))
-            pred_lats = torch.tensor(pred_lats, dtype=torch.float)
-            pred_lngs = torch.tensor(pred_lngs, dtype=torch.float)
+            pred_lats, pred_lngs = self.get_lat_lngs(i, pred_class_indexes)
             # calculate error
             distances = utils_global.vectorized_gc_distance(
                 pred_lats,
@@ -176,7 +350,68 @@ class MultiPartitioningClassifier(pl.LightningModule):
         for metric_name, metric_value in metrics.items():
             self.log(metric_name, metric_value, logger=True)
 
-    def _multi_crop_inference(self, batch):
+    def multi_crop_log_probs(self, fv, ncrops, topk_coarse=None):
+        """Log-probabilities [B, classes] per partitioning from the features of
+        B * ncrops crops, max over the crops of an image.
+
+        With topk_coarse, the finer classifiers are only evaluated for classes whose
+        coarsest parent is among the topk_coarse most likely coarse classes. All other
+        classes are set to -inf and the log-probabilities are normalized over the
+        evaluated classes only, separately for each crop. For a single crop the
+        hierarchical prediction is exact as long as its coarsest parent is among the
+        top-k. For multiple crops it is approximate, since the max over crops compares
+        log-probabilities of different normalizers.
+        """
+
+        def _max_over_crops(yhat):
+            # respape back to access individual crops
+            yhat = torch.reshape(yhat, (-1, ncrops, *list(yhat.shape[1:])))
+            # calculate max over crops (log is monotonic, i.e. log of max probability)
+            return torch.max(yhat, dim=1)[0]
+
+        if topk_coarse is None or self.hierarchy is None:
+            yhats = [self.classifier[i](fv) for i in range(len(self.partitionings))]
+            return [
+                _max_over_crops(torch.nn.functional.log_softmax(yhat, dim=1))
+                for yhat in yhats
+            ]
+
+        coarse = _max_over_crops(
+            torch.nn.functional.log_softmax(self.classifier[0](fv), dim=1)
+        )
+        top = torch.topk(
+            coarse.masked_fill(~self.coarse_has_children, float("-inf")),
+            min(topk_coarse, coarse.shape[1]),
+            dim=1,
+        )[1]
+        # selected coarse classes per image, the last column is never selected and
+        # used for classes without parent (-1)
+        selected = coarse.new_zeros((coarse.shape[0], coarse.shape[1] + 1), dtype=bool)
+        selected.scatter_(1, top, True)
+
+        yhats = [coarse]
+        for i in range(1, len(self.partitionings)):
+            candidates = selected[:, getattr(self, f"coarse_parent_{i}")]
+            # evaluate the union of candidates of all images in the batch
+            columns = torch.nonzero(candidates.any(dim=0), as_tuple=True)[0]
+            logits = torch.nn.functional.linear(
+                fv,
+                self.classifier[i].weight[columns],
+                self.classifier[i].bias[columns],
+            )
+            mask = candidates[:, columns].repeat_interleave(ncrops, dim=0)
+            logits = logits.masked_fill(~mask, float("-inf"))
+
+            yhat = coarse.new_full(
+                (coarse.shape[0], candidates.shape[1]), float("-inf")
+            )
+            yhat[:, columns] = _max_over_crops(
+                torch.nn.functional.log_softmax(logits, dim=1)
+            )
+            yhats.append(yhat)
+        return yhats
+
+    def _multi_crop_inference(self, batch, topk_coarse=None):
         images, meta_batch = batch
         cur_batch_size = images.shape[0]
         ncrops = images.shape[1]
@@ -185,31 +420,20 @@ class MultiPartitioningClassifier(pl.LightningModule):
         images = torch.reshape(images, (cur_batch_size * ncrops, *images.shape[2:]))
 
         # forward pass
-        yhats = self(images)
-        yhats = [torch.nn.functional.softmax(yhat, dim=1) for yhat in yhats]
-
-        # respape back to access individual crops
-        yhats = [
-            torch.reshape(yhat, (cur_batch_size, ncrops, *list(yhat.shape[1:])))
-            for yhat in yhats
-        ]
-
-        # calculate max over crops
-        yhats = [torch.max(yhat, dim=1)[0] for yhat in yhats]
+        fv = self.model(images)
+        yhats = self.multi_crop_log_probs(fv, ncrops, topk_coarse)
 
         hierarchy_preds = None
         if self.hierarchy is not None:
-            hierarchy_logits = torch.stack(
-                [yhat[:, self.hierarchy.M[:, i]] for i, yhat in enumerate(yhats)],
-                dim=-1,
-            )
-            hierarchy_preds = torch.prod(hierarchy_logits, dim=-1)
+            hierarchy_preds = self.hierarchy_scores(yhats)
 
         return yhats, meta_batch, hierarchy_preds
 
-    def inference(self, batch):
+    def inference(self, batch, topk_coarse=None):
 
-        yhats, meta_batch, hierarchy_preds = self._multi_crop_inference(batch)
+        yhats, meta_batch, hierarchy_preds = self._multi_crop_inference(
+            batch, topk_coarse
+        )
 
         if self.hierarchy is not None:
             nparts = len(self.partitionings) + 1
@@ -230,17 +454,7 @@ class MultiPartitioningClassifier(pl.LightningModule):
                 pred_classes = torch.argmax(yhats[i], dim=1)
 
             # calculate GCD
-            pred_lats, pred_lngs = map(
-                list,
-                zip(
-                    *[
-                        self.partitionings[i].get_lat_lng(c)
-                        for c in pred_classes.tolist()
-                    ]
-                ),
-            )
-            pred_lats = torch.tensor(pred_lats, dtype=torch.float)
-            pred_lngs = torch.tensor(pred_lngs, dtype=torch.float)
+            pred_lats, pred_lngs = self.get_lat_lngs(i, pred_classes)
             pred_lat_dict[pname] = pred_lats
             pred_lng_dict[pname] = pred_lngs
             pred_class_dict[pname] = pred_classes
@@ -268,17 +482,7 @@ class MultiPartitioningClassifier(pl.LightningModule):
                 pred_classes = torch.argmax(yhats[i], dim=1)
 
             # calculate GCD
-            pred_lats, pred_lngs = map(
-                list,
-                zip(
-                    *[
-                        self.partitionings[i].get_lat_lng(c)
-                        for c in pred_classes.tolist()
-                    ]
-                ),
-            )
-            pred_lats = torch.tensor(pred_lats, dtype=torch.float)
-            pred_lngs = torch.tensor(pred_lngs, dtype=torch.float)
+            pred_lats, pred_lngs = self.get_lat_lngs(i, pred_classes)
 
             distances = utils_global.vectorized_gc_distance(
                 pred_lats,
@@ -313,30 +517,64 @@ class MultiPartitioningClassifier(pl.LightningModule):
             },
         }
 
+    def on_train_epoch_start(self):
+        dataset = self.trainer.train_dataloader.dataset
+        if self._train_dataset_state is not None:
+            # continue the interrupted epoch of the training data (Lightning itself
+            # continues with the next epoch)
+            dataset.load_state_dict(self._train_dataset_state)
+            self._train_dataset_state = None
+        else:
+            # new shard order and assignment to ranks / workers, identical on all ranks
+            dataset.set_epoch(self.current_epoch)
+
     def train_dataloader(self):
 
-        with open(self.hparams.train_label_mapping, "r") as f:
-            target_mapping = json.load(f)
+        target_mapping = None
+        if not getattr(self.hparams, "embedded_labels", False):
+            target_mapping = load_label_mapping(self.hparams.train_label_mapping)
+        else:
+            # stale labels would silently train on the classes of old partitionings
+            check_shard_labels(
+                self.hparams.msgpack_train_dir,
+                self.hparams.train_label_mapping,
+                len(self.partitionings),
+            )
 
-        tfm = torchvision.transforms.Compose(
-            [
-                torchvision.transforms.RandomHorizontalFlip(),
-                torchvision.transforms.RandomResizedCrop(224, scale=(0.66, 1.0)),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(
-                    (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
-                ),
-            ]
-        )
+        if getattr(self.hparams, "uint8_loader", False):
+            # flip and normalization of whole batches on the device, see training_step
+            tfm = torchvision.transforms.Compose(
+                [
+                    torchvision.transforms.RandomResizedCrop(224, scale=(0.66, 1.0)),
+                    pil_to_uint8_tensor,
+                ]
+            )
+        else:
+            tfm = torchvision.transforms.Compose(
+                [
+                    torchvision.transforms.RandomHorizontalFlip(),
+                    torchvision.transforms.RandomResizedCrop(224, scale=(0.66, 1.0)),
+                    torchvision.transforms.ToTensor(),
+                    torchvision.transforms.Normalize(
+                        (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+                    ),
+                ]
+            )
 
         dataset = MsgPackIterableDatasetMultiTargetWithDynLabels(
             path=self.hparams.msgpack_train_dir,
             target_mapping=target_mapping,
             key_img_id=self.hparams.key_img_id,
             key_img_encoded=self.hparams.key_img_encoded,
+            jpeg_draft=getattr(self.hparams, "jpeg_draft", False),
+            embedded_labels=getattr(self.hparams, "embedded_labels", False),
+            readahead_mb=getattr(self.hparams, "readahead_mb", 64),
+            mmap_shards=getattr(self.hparams, "mmap_shards", False),
             shuffle=True,
+            shuffle_buffer_mb=getattr(self.hparams, "shuffle_buffer_mb", 256),
             transformation=tfm,
         )
+        dataset.track_progress(self.hparams.num_workers_per_loader)
 
         dataloader = torch.utils.data.DataLoader(
             dataset,
@@ -348,28 +586,48 @@ class MultiPartitioningClassifier(pl.LightningModule):
 
     def val_dataloader(self):
 
-        with open(self.hparams.val_label_mapping, "r") as f:
-            target_mapping = json.load(f)
+        target_mapping = None
+        if not getattr(self.hparams, "embedded_labels", False):
+            target_mapping = load_label_mapping(self.hparams.val_label_mapping)
+        else:
+            # stale labels would silently train on the classes of old partitionings
+            check_shard_labels(
+                self.hparams.msgpack_val_dir,
+                self.hparams.val_label_mapping,
+                len(self.partitionings),
+            )
 
-        tfm = torchvision.transforms.Compose(
-            [
-                torchvision.transforms.Resize(256),
-                torchvision.transforms.CenterCrop(224),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize(
-                    (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
-                ),
-            ]
-        )
+        if getattr(self.hparams, "uint8_loader", False):
+            tfm = torchvision.transforms.Compose(
+                [
+                    torchvision.transforms.Resize(256),
+                    torchvision.transforms.CenterCrop(224),
+                    pil_to_uint8_tensor,
+                ]
+            )
+        else:
+            tfm = torchvision.transforms.Compose(
+                [
+                    torchvision.transforms.Resize(256),
+                    torchvision.transforms.CenterCrop(224),
+                    torchvision.transforms.ToTensor(),
+                    torchvision.transforms.Normalize(
+                        (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+                    ),
+                ]
+            )
         dataset = MsgPackIterableDatasetMultiTargetWithDynLabels(
             path=self.hparams.msgpack_val_dir,
             target_mapping=target_mapping,
             key_img_id=self.hparams.key_img_id,
             key_img_encoded=self.hparams.key_img_encoded,
+            jpeg_draft=getattr(self.hparams, "jpeg_draft", False),
+            embedded_labels=getattr(self.hparams, "embedded_labels", False),
+            readahead_mb=getattr(self.hparams, "readahead_mb", 64),
+            mmap_shards=getattr(self.hparams, "mmap_shards", False),
             shuffle=False,
             transformation=tfm,
             meta_path=self.hparams.val_meta_path,
-            cache_size=1024,
         )
 
         dataloader = torch.utils.data.DataLoader(
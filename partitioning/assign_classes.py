@@ -1,45 +1,115 @@
 import argparse
 import logging
+import os
 import yaml
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from typing import Union
+from time import time
 
+import numpy as np
 import pandas as pd
-import s2sphere as s2
-from tqdm import tqdm
 
-tqdm.pandas()
+from classification.s2_utils import CellIndex, latlng_to_cell_id
+from classification.label_mapping import LabelMapping
 
 
-def create_s2_cell(latlng):
-    p1 = s2.LatLng.from_degrees(latlng["lat"], latlng["lng"])
-    cell = s2.Cell.from_lat_lng(p1)
-    return cell
+def load_partitioning_index(partitioning_file, skiprows) -> CellIndex:
+    partitioning = pd.read_csv(partitioning_file, encoding="utf-8", skiprows=skiprows)
+    return CellIndex.from_tokens(
+        partitioning["hex_id"], partitioning["class_label"].to_numpy(dtype=np.int32)
+    )
+
+
+def assign_class_index(cell_ids: np.ndarray, index: CellIndex) -> np.ndarray:
+    # class index of the cell containing each leaf cell or -1 since not all regions
+    # are covered
+    return index.lookup(cell_ids, missing=-1)
+
+
+# partitioning indexes of each worker process, set once by the pool initializer
+_indexes = None
+
+
+def _init_worker(indexes):
+    global _indexes
+    _indexes = indexes
+
+
+def assign_cell_classes(img_ids, cell_ids, indexes) -> pd.DataFrame:
+    # class index of each image (row) for each partitioning (column)
+    targets = np.stack(
+        [assign_class_index(cell_ids, index) for index in indexes.values()], axis=1
+    )
+    return pd.DataFrame(targets, index=img_ids, columns=list(indexes))
+
+
+def assign_classes(df, col_img_id, col_lat, col_lng, indexes) -> pd.DataFrame:
+    # the leaf cell of each image is computed once for all partitionings
+    cell_ids = latlng_to_cell_id(df[col_lat].to_numpy(), df[col_lng].to_numpy())
+    return assign_cell_classes(df[col_img_id].to_numpy(), cell_ids, indexes)
+
+
+def write_label_mapping(df_mapping, output_file: Path):
+    # json (orient=index) for the legacy format, LabelMapping otherwise
+    if output_file.suffix == ".json":
+        df_mapping = df_mapping.agg(list, axis="columns")
+        df_mapping.to_json(output_file, orient="index")
+    else:
+        LabelMapping.from_arrays(df_mapping.index, df_mapping.to_numpy()).save(
+            output_file
+        )
+
 
+def _assign_classes_worker(df, col_img_id, col_lat, col_lng):
+    return assign_classes(df, col_img_id, col_lat, col_lng, _indexes)
 
-def get_id_s2cell_mapping_from_raw(
-    csv_file, col_img_id, col_lat, col_lng
-) -> pd.DataFrame:
 
-    usecols = [col_img_id, col_lat, col_lng]
-    df = pd.read_csv(csv_file, usecols=usecols)
-    df = df.rename(columns={k: v for k, v in zip(usecols, ["img_path", "lat", "lng"])})
+def process_split(dataset_type, config, args, pool):
+    meta_file = config[f"{dataset_type}_meta_path"]
+    output_file = Path(config[f"{dataset_type}_label_mapping"])
+    logging.info(f"[{dataset_type}] {meta_file} -> {output_file}")
+    output_file.parent.mkdir(exist_ok=True, parents=True)
 
-    logging.info("Initialize s2 cells...")
-    df["s2cell"] = df[["lat", "lng"]].progress_apply(create_s2_cell, axis=1)
-    df = df.set_index(df["img_path"])
-    return df[["s2cell"]]
+    logging.info(f"[{dataset_type}] Load CSV and assign classes")
+    start = time()
+    usecols = [args.column_img_path, args.column_lat, args.column_lng]
+    reader = pd.read_csv(meta_file, usecols=usecols, chunksize=args.chunksize)
+    f = partial(
+        _assign_classes_worker,
+        col_img_id=args.column_img_path,
+        col_lat=args.column_lat,
+        col_lng=args.column_lng,
+    )
+    df_mapping = pd.concat(pool.imap(f, reader))
+    logging.info(f"[{dataset_type}] Time assigning classes: {time() - start:.2f}s")
 
+    for column_name in df_mapping.columns:
+        nans = (df_mapping[column_name] < 0).sum()
+        logging.info(
+            f"[{dataset_type}] {column_name}: Cannot assign a hexid for {nans} of "
+            f"{len(df_mapping.index)} images "
+            f"({nans / len(df_mapping.index) * 100:.2f}%)"
+        )
 
-def assign_class_index(cell: s2.Cell, mapping: dict) -> Union[int, None]:
+    logging.info(
+        f"[{dataset_type}] Remove all images that could not be assigned a cell"
+    )
+    original_dataset_size = len(df_mapping.index)
+    df_mapping = df_mapping[(df_mapping >= 0).all(axis="columns")]
 
-    for l in range(2, 30):
-        cell_parent = cell.id().parent(l)
-        hexid = cell_parent.to_token()
-        if hexid in mapping:
-            return int(mapping[hexid])  # class index
+    fraction = len(df_mapping.index) / original_dataset_size * 100
+    logging.info(
+        f"[{dataset_type}] Final dataset size: {len(df_mapping.index)}/"
+        f"{original_dataset_size} ({fraction:.2f})% from original"
+    )
 
-    return None  # valid return since not all regions are covered
+    # store final dataset to file
+    logging.info(f"[{dataset_type}] Store dataset to {output_file}")
+    start = time()
+    write_label_mapping(df_mapping, output_file)
+    logging.info(f"[{dataset_type}] Time storing dataset: {time() - start:.2f}s")
 
 
 def parse_args():
@@ -65,6 +135,18 @@ def parse_args():
         default=2,
         help="skip first n rows for each partitioning",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes to assign classes in parallel",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=100000,
+        help="Number of images per task of a worker",
+    )
     args = parser.parse_args()
     return args
 
@@ -84,69 +166,28 @@ if __name__ == "__main__":
     )
 
     config = config["model_params"]
-    for dataset_type in ["val", "train"]:
-        label_mapping_file = config[f"{dataset_type}_meta_path"]
-        output_file = config[f"{dataset_type}_label_mapping"]
-        logging.info(label_mapping_file)
-        logging.info(output_file)
-        output_file = Path(output_file)
-        output_file.parent.mkdir(exist_ok=True, parents=True)
-
-        logging.info("Load CSV and initialize s2 cells")
-        logging.info(f"Column image path: {args.column_img_path}")
-        logging.info(f"Column latitude: {args.column_lat}")
-        logging.info(f"Column longitude: {args.column_lng}")
-        df_mapping = get_id_s2cell_mapping_from_raw(
-            label_mapping_file,
-            col_img_id=args.column_img_path,
-            col_lat=args.column_lat,
-            col_lng=args.column_lng,
-        )
-
-        partitioning_files = [Path(p) for p in config["partitionings"]["files"]]
-        for partitioning_file in partitioning_files:
-            column_name = partitioning_file.name.split(".")[0]
-            logging.info(f"Processing partitioning: {column_name}")
-            partitioning = pd.read_csv(
-                partitioning_file,
-                encoding="utf-8",
-                index_col="hex_id",
-                skiprows=args.skiprows,
-            )
-
-            # create column with class indexes for respective partitioning
-            mapping = partitioning["class_label"].to_dict()
-            df_mapping[column_name] = df_mapping["s2cell"].progress_apply(
-                lambda cell: assign_class_index(cell, mapping)
-            )
-            nans = df_mapping[column_name].isna().sum()
-            logging.info(
-                f"Cannot assign a hexid for {nans} of {len(df_mapping.index)} images "
-                f"({nans / len(df_mapping.index) * 100:.2f}%)"
-            )
-
-        # drop unimportant information
-        df_mapping = df_mapping.drop(columns=["s2cell"])
-        logging.info("Remove all images that could not be assigned a cell")
-        original_dataset_size = len(df_mapping.index)
-        df_mapping = df_mapping.dropna()
-        column_names = []
-        for partitioning_file in partitioning_files:
-            column_name = partitioning_file.name.split(".")[0]
-            column_names.append(column_name)
-            df_mapping[column_name] = df_mapping[column_name].astype("int32")
-
-        df_mapping["targets"] = df_mapping[column_names].agg(list, axis="columns")
-
-        fraction = len(df_mapping.index) / original_dataset_size * 100
-        logging.info(
-            f"Final dataset size: {len(df_mapping.index)}/{original_dataset_size} ({fraction:.2f})% from original"
+    logging.info(f"Column image path: {args.column_img_path}")
+    logging.info(f"Column latitude: {args.column_lat}")
+    logging.info(f"Column longitude: {args.column_lng}")
+
+    start = time()
+    indexes = {}
+    for partitioning_file in [Path(p) for p in config["partitionings"]["files"]]:
+        column_name = partitioning_file.name.split(".")[0]
+        logging.info(f"Load partitioning: {column_name}")
+        indexes[column_name] = load_partitioning_index(partitioning_file, args.skiprows)
+    logging.info(f"Time loading partitionings: {time() - start:.2f}s")
+
+    # all partitionings share the s2 cell computation of each chunk, chunks of
+    # both splits are processed concurrently by the same pool
+    start = time()
+    dataset_types = ["val", "train"]
+    with Pool(
+        args.num_workers, initializer=_init_worker, initargs=(indexes,)
+    ) as pool, ThreadPool(len(dataset_types)) as split_pool:
+        split_pool.map(
+            partial(process_split, config=config, args=args, pool=pool), dataset_types
         )
-
-        # store final dataset to file
-        logging.info(f"Store dataset to {output_file}")
-
-        df_mapping = df_mapping["targets"]
-        df_mapping.to_json(output_file, orient="index")
+    logging.info(f"Total time: {time() - start:.2f}s")
 
     exit(0)
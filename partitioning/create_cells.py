@@ -1,15 +1,32 @@
 import csv
 import os
+import re
 import logging
 import sys
 import argparse
 from time import time
-from functools import partial
-from multiprocessing import Pool
-from collections import Counter
+from pathlib import Path
+from typing import NamedTuple
 
+import numpy as np
 import pandas as pd
-import s2sphere as s2
+
+from classification.s2_utils import (
+    latlng_to_cell_id,
+    cell_id_level,
+    cell_id_parent,
+    cell_id_children,
+    cell_id_range_min,
+    cell_id_range_max,
+    cell_id_to_token,
+    token_to_cell_id,
+    CellIndex,
+)
+from partitioning.assign_classes import (
+    assign_classes,
+    assign_cell_classes,
+    write_label_mapping,
+)
 
 
 def parse_args():
@@ -33,6 +50,13 @@ def parse_args():
         "-clng", "--column_lng", type=str, default="LON", help="column name longitude"
     )
 
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="Read the dataset in chunks of n rows to limit memory usage",
+    )
+
     parser.add_argument(
         "--output", type=str, required=False, help="Path to output directory"
     )
@@ -40,14 +64,18 @@ def parse_args():
     parser.add_argument(
         "--img_min",
         type=int,
+        nargs="+",
         required=True,
-        help="Minimum number of images per geographical cell",
+        help="Minimum number of images per geographical cell. "
+        "Either one value for all partitionings or one value per --img_max",
     )
     parser.add_argument(
         "--img_max",
         type=int,
+        nargs="+",
         required=True,
-        help="Maximum number of images per geographical cell",
+        help="Maximum number of images per geographical cell. "
+        "Multiple values create multiple partitionings in a single run",
     )
 
     parser.add_argument(
@@ -65,82 +93,392 @@ def parse_args():
         help="Maximum partitioning level",
     )
 
+    parser.add_argument(
+        "--state",
+        type=str,
+        required=False,
+        help="Path to a file (*.npz) that stores the images aggregated per cell, "
+        "required to update partitionings with new images later on",
+    )
+    parser.add_argument(
+        "--update",
+        type=str,
+        nargs="+",
+        required=False,
+        help="Existing partitioning(s) to update with the images of --dataset, "
+        "one per --img_max. Requires the --state of the previous run",
+    )
+    parser.add_argument(
+        "--label_mapping",
+        type=Path,
+        required=False,
+        help="Also assign the classes of all created partitionings to the images of "
+        "--dataset and store them as label mapping (*.npy or *.json), "
+        "i.e. without a separate run of assign_classes. Not available with --update",
+    )
+
     args = parser.parse_args()
+    if args.update is not None:
+        if args.state is None:
+            parser.error("--update requires --state")
+        if len(args.update) != len(args.img_max):
+            parser.error("--update requires one partitioning per --img_max")
+        if args.label_mapping is not None:
+            # the state holds no image ids, i.e. the previous images can't be assigned
+            parser.error(
+                "--label_mapping is not available with --update, "
+                "run partitioning.assign_classes on all images instead"
+            )
+    if len(args.img_min) == 1:
+        args.img_min = args.img_min * len(args.img_max)
+    if len(args.img_min) != len(args.img_max):
+        parser.error("--img_min requires one value or as many values as --img_max")
     return args
 
 
-def _init_parallel(img, level):
-    cell = create_s2_cell(img[1], img[2])
-    hexid = create_cell_at_level(cell, level)
-    return [*img, hexid, cell]
+class CellStats(NamedTuple):
+    """Number of images and sum of their coordinates per S2 cell, sorted by cell id"""
 
+    cell_ids: np.ndarray
+    counts: np.ndarray
+    lat_sums: np.ndarray
+    lng_sums: np.ndarray
 
-def init_cells(img_container_0, level):
+
+def _reduce_cell_stats(stats):
+    # sum up the statistics of equal cell ids
+    order = np.argsort(stats.cell_ids, kind="stable")
+    cell_ids = stats.cell_ids[order]
+    if len(cell_ids) == 0:
+        return stats
+    first = np.flatnonzero(np.r_[True, cell_ids[1:] != cell_ids[:-1]])
+    return CellStats(
+        cell_ids[first], *(np.add.reduceat(x[order], first) for x in stats[1:])
+    )
+
+
+def compute_cell_stats(leaf_ids, lats, lngs, level):
+    cell_ids = cell_id_parent(leaf_ids, level)
+    counts = np.ones(len(cell_ids), dtype=np.int64)
+    return _reduce_cell_stats(CellStats(cell_ids, counts, lats, lngs))
+
+
+def merge_cell_stats(stats_0, stats_1):
+    # both inputs are sorted, i.e. the stable sort only merges two runs
+    return _reduce_cell_stats(
+        CellStats(*(np.concatenate(x) for x in zip(stats_0, stats_1)))
+    )
+
+
+class ImageContainer(NamedTuple):
+    """Images aggregated per S2 cell, sorted by cell id and stored as cumulative
+    sums. The images of the rows [start, end) sum up to cum[end] - cum[start].
+    """
+
+    cell_ids: np.ndarray
+    cum_counts: np.ndarray
+    cum_coords: np.ndarray
+
+    @classmethod
+    def from_stats(cls, stats):
+        cum_counts = np.zeros(len(stats.cell_ids) + 1, dtype=np.int64)
+        np.cumsum(stats.counts, out=cum_counts[1:])
+        cum_coords = np.zeros((len(stats.cell_ids) + 1, 2))
+        np.cumsum(stats.lat_sums, out=cum_coords[1:, 0])
+        np.cumsum(stats.lng_sums, out=cum_coords[1:, 1])
+        return cls(stats.cell_ids, cum_counts, cum_coords)
+
+    def stats(self):
+        return CellStats(
+            self.cell_ids,
+            np.diff(self.cum_counts),
+            np.diff(self.cum_coords[:, 0]),
+            np.diff(self.cum_coords[:, 1]),
+        )
+
+    def select_ranges(self, start, end):
+        # container of the disjoint, sorted row ranges [start, end)
+        lengths = end - start
+        rows = np.repeat(start - np.cumsum(lengths) + lengths, lengths) + np.arange(
+            lengths.sum()
+        )
+        coords_sums = self.cum_coords[rows + 1] - self.cum_coords[rows]
+        return ImageContainer.from_stats(
+            CellStats(
+                self.cell_ids[rows],
+                self.counts(rows, rows + 1),
+                coords_sums[:, 0],
+                coords_sums[:, 1],
+            )
+        )
+
+    def counts(self, start, end):
+        return self.cum_counts[end] - self.cum_counts[start]
+
+    def coords_mean(self, start, end):
+        coords_sum = self.cum_coords[end] - self.cum_coords[start]
+        return coords_sum / self.counts(start, end)[:, None]
+
+
+class Cells(NamedTuple):
+    """Disjoint S2 cells sorted by cell id. Cell k holds the images of the rows
+    img_container[start[k]:end[k]] since the container is sorted by cell id as well.
+    """
+
+    cell_ids: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    counts: np.ndarray
+
+    def select(self, mask):
+        return Cells(*(x[mask] for x in self))
+
+
+def init_cells(img_container, level):
 
     start = time()
-    f = partial(_init_parallel, level=level)
-    img_container = []
-    with Pool(8) as p:
-        for x in p.imap_unordered(f, img_container_0, chunksize=1000):
-            img_container.append(x)
-    logging.debug(f"Time multiprocessing: {time() - start:.2f}s")
-    start = time()
-    h = dict(Counter(list(list(zip(*img_container))[3])))
+    cell_ids, first = np.unique(
+        cell_id_parent(img_container.cell_ids, level), return_index=True
+    )
+    end = np.r_[first[1:], len(img_container.cell_ids)]
+    h = Cells(cell_ids, first, end, img_container.counts(first, end))
     logging.debug(f"Time creating h: {time() - start:.2f}s")
 
-    return img_container, h
-
-
-def delete_cells(img_container, h, t_min):
-    del_cells = {k for k, v in h.items() if v <= t_min}
-    h = {k: v for k, v in h.items() if v > t_min}
-    img_container_f = []
-    for img in img_container:
-        hexid = img[3]
-        if hexid not in del_cells:
-            img_container_f.append(img)
-    return img_container_f, h
-
-
-def gen_subcells(img_container_0, h_0, level, t_max):
-    img_container = []
-    h = {}
-    for img in img_container_0:
-        hexid_0 = img[3]
-        if h_0[hexid_0] > t_max:
-            hexid = create_cell_at_level(img[4], level)
-            img[3] = hexid
-            try:
-                h[hexid] = h[hexid] + 1
-            except:
-                h[hexid] = 1
-        else:
-            try:
-                h[hexid_0] = h[hexid_0] + 1
-            except:
-                h[hexid_0] = 1
-        img_container.append(img)
-    return img_container, h
+    return h
 
 
-def create_s2_cell(lat, lng):
-    p1 = s2.LatLng.from_degrees(lat, lng)
-    cell = s2.Cell.from_lat_lng(p1)
-    return cell
+def delete_cells(h, t_min):
+    return h.select(h.counts > t_min)
 
 
-def create_cell_at_level(cell, level):
-    cell_parent = cell.id().parent(level)
-    hexid = cell_parent.to_token()
-    return hexid
+def gen_subcells(img_container, h_0):
+    # the rows of each child cell are found by binary search on the sorted cell ids
+    cell_ids = cell_id_children(h_0.cell_ids).ravel()
+    start, end = _cell_rows(img_container, cell_ids)
+    counts = img_container.counts(start, end)
+    return Cells(cell_ids, start, end, counts).select(counts > 0)
 
 
-def write_output(args, img_container, h, num_images, out_p):
+def build_cell_tree(img_container, h, level, lvl_max, t_max):
+    """Adaptive quadtree as list of cells per level, starting with the cells h of the
+    given level. Each cell above t_max is split into its non-empty children.
+    """
+    tree = [h]
+    while np.any(tree[-1].counts > t_max) and level < lvl_max:
+        level = level + 1
+        start = time()
+        h = tree[-1]
+        tree.append(gen_subcells(img_container, h.select(h.counts > t_max)))
+        logging.info(
+            f"Level {level} - Time: {time() - start:.2f}s - "
+            f"Number of cells: {len(tree[-1].cell_ids)}"
+        )
+    return tree
+
+
+def select_cells(tree, t_min, t_max):
+    """Partitioning for the thresholds t_min, t_max from a tree that was built with a
+    threshold <= t_max, i.e. every cell above t_max has its children in the tree.
+    """
+    h = delete_cells(tree[0], t_min)
+    selected = []
+    for subcells in tree[1:]:
+        split = h.counts > t_max
+        selected.append(h.select(~split))
+        if not np.any(split):
+            h = None
+            break
+        parents = cell_id_parent(
+            subcells.cell_ids, cell_id_level(subcells.cell_ids) - 1
+        )
+        h = subcells.select(np.isin(parents, h.cell_ids[split]))
+    if h is not None:
+        selected.append(h)
+
+    return delete_cells(_concat_cells(selected), t_min)
+
+
+def split_cells(img_container, h, t_min, t_max, lvl_max, blocked=None):
+    """Split cells until they hold at most t_max images or reach lvl_max. Cells that
+    contain any of the sorted cell ids in blocked are split as well. Cells with at
+    most t_min images are removed afterwards.
+    """
+    selected = []
+    while True:
+        split = h.counts > t_max
+        if blocked is not None:
+            split |= np.searchsorted(blocked, cell_id_range_min(h.cell_ids)) < (
+                np.searchsorted(blocked, cell_id_range_max(h.cell_ids), side="right")
+            )
+        split &= cell_id_level(h.cell_ids) < lvl_max
+        selected.append(h.select(~split))
+        if not np.any(split):
+            break
+        h = gen_subcells(img_container, h.select(split))
+    return delete_cells(_concat_cells(selected), t_min)
+
+
+def update_cells(cells, img_container, delta, img_min, img_max, lvl_min, lvl_max):
+    """Update an existing partitioning (DataFrame in the output format) with new images.
+
+    delta holds the new images, img_container all images including the new ones.
+    Existing class labels are kept: the largest subcell of a cell that exceeds img_max
+    keeps its label, the other subcells and new cells in regions without any cell
+    are appended with new labels. Only the rows of img_container within cells that
+    received new images are processed.
+    """
+    cell_ids = token_to_cell_id(cells["hex_id"])
+    order = np.argsort(cell_ids)
+    cell_ids = cell_ids[order]
+    labels = cells["class_label"].to_numpy()[order]
+    counts_0 = cells["imgs_per_cell"].to_numpy()[order]
+    coords_0 = cells[["latitude_mean", "longitude_mean"]].to_numpy()[order]
+
+    # running update of counts and mean coordinates
+    start, end = _cell_rows(delta, cell_ids)
+    counts = counts_0 + delta.counts(start, end)
+    coords_sum = coords_0 * counts_0[:, None] + (
+        delta.cum_coords[end] - delta.cum_coords[start]
+    )
+    coords_mean = coords_sum / counts[:, None]
+
+    # split cells above img_max with the images of all updates so far
+    split = np.flatnonzero((counts > img_max) & (cell_id_level(cell_ids) < lvl_max))
+    start, end = _cell_rows(img_container, cell_ids[split])
+    h = Cells(cell_ids[split], start, end, img_container.counts(start, end))
+    subcells = split_cells(img_container, h, img_min, img_max, lvl_max)
+    parents = (
+        np.searchsorted(
+            cell_id_range_min(cell_ids[split]), subcells.cell_ids, side="right"
+        )
+        - 1
+    )
+    # a cell without any remaining subcell is kept to not lose its class label
+    keep = np.ones(len(cell_ids), dtype=bool)
+    keep[split[parents]] = False
+    order = np.lexsort((-subcells.counts, parents))
+    inherit = order[np.r_[True, np.diff(parents[order]) != 0][: len(order)]]
+    subcell_labels = np.full(len(subcells.cell_ids), -1, dtype=np.int64)
+    subcell_labels[inherit] = labels[split[parents[inherit]]]
+    logging.info(
+        f"Split {len(split) - keep[split].sum()} cells into "
+        f"{len(subcells.cell_ids)} subcells"
+    )
+
+    # new cells from images outside of all cells, restricted to the level lvl_min
+    # cells that received new images outside of all cells
+    covered_ids = np.sort(np.r_[cell_ids[keep], subcells.cell_ids])
+    roots = np.unique(
+        cell_id_parent(delta.cell_ids[~_covered_rows(delta, covered_ids)], lvl_min)
+    )
+    container_roots = img_container.select_ranges(*_cell_rows(img_container, roots))
+    uncovered = ~_covered_rows(container_roots, covered_ids)
+    stats = container_roots.stats()
+    container_new = ImageContainer.from_stats(CellStats(*(x[uncovered] for x in stats)))
+    h = delete_cells(init_cells(container_new, lvl_min), img_min)
+    new_cells = split_cells(
+        container_new, h, img_min, img_max, lvl_max, blocked=covered_ids
+    )
+    logging.info(f"Created {len(new_cells.cell_ids)} new cells")
+
+    # append new class labels in cell id order
+    is_new = np.r_[subcell_labels == -1, np.ones(len(new_cells.cell_ids), dtype=bool)]
+    added_labels = labels.max() + 1 + np.arange(is_new.sum())
+    all_labels = np.r_[subcell_labels, np.full(len(new_cells.cell_ids), -1)]
+    all_labels[is_new] = added_labels
+
+    updated = pd.DataFrame(
+        {
+            "class_label": np.r_[labels[keep], all_labels],
+            "hex_id": cell_id_to_token(
+                np.r_[cell_ids[keep], subcells.cell_ids, new_cells.cell_ids]
+            ),
+            "imgs_per_cell": np.r_[counts[keep], subcells.counts, new_cells.counts],
+        }
+    )
+    updated[["latitude_mean", "longitude_mean"]] = np.r_[
+        coords_mean[keep],
+        img_container.coords_mean(subcells.start, subcells.end),
+        container_new.coords_mean(new_cells.start, new_cells.end),
+    ]
+    return updated.sort_values("class_label")
+
+
+def _cell_rows(img_container, cell_ids):
+    # rows [start, end) of the container that belong to the given cells
+    start = np.searchsorted(
+        img_container.cell_ids, cell_id_range_min(cell_ids), side="left"
+    )
+    end = np.searchsorted(
+        img_container.cell_ids, cell_id_range_max(cell_ids), side="right"
+    )
+    return start, end
+
+
+def _covered_rows(img_container, cell_ids):
+    # mask of all container rows within any of the given disjoint cells
+    start, end = _cell_rows(img_container, cell_ids)
+    delta = np.zeros(len(img_container.cell_ids) + 1, dtype=np.int64)
+    np.add.at(delta, start, 1)
+    np.add.at(delta, end, -1)
+    return np.cumsum(delta[:-1]) > 0
+
+
+def _concat_cells(cells):
+    h = Cells(*(np.concatenate(x) for x in zip(*cells)))
+    return h.select(np.argsort(h.cell_ids))
+
+
+def read_cells(csv_file):
+    # partitionings may contain additional lines before the column names
+    with open(csv_file) as f:
+        skiprows = next(i for i, line in enumerate(f) if line.startswith("class_label"))
+    return pd.read_csv(csv_file, skiprows=skiprows)
+
+
+def save_state(state_file, stats, lvl_max, num_images):
+    # write to a temporary file first, i.e. an interrupted write keeps the old state
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez(
+            f,
+            **stats._asdict(),
+            lvl_max=lvl_max,
+            num_images=num_images,
+        )
+    os.replace(tmp_file, state_file)
+
+
+def load_state(state_file):
+    with np.load(state_file) as f:
+        stats = CellStats(*(f[k] for k in CellStats._fields))
+        return stats, int(f["lvl_max"]), int(f["num_images"])
+
+
+def check_update_files(cells_files, num_images):
+    """Partitionings to update have to be created from the images of the state, i.e.
+    their file names (see write_output) hold its number of images
+    """
+    for cells_file in cells_files:
+        match = re.search(r"_images_(\d+)\.csv$", str(cells_file))
+        if match is None:
+            logging.warning(
+                f"Number of images of {cells_file} unknown, can't check that it "
+                "belongs to the state"
+            )
+        elif int(match.group(1)) != num_images:
+            raise ValueError(
+                f"{cells_file} was created from {match.group(1)} images, but the "
+                f"state holds {num_images} images"
+            )
+
+
+def write_output(cells, img_min, img_max, num_images, out_p):
 
     if not os.path.exists(out_p):
         os.makedirs(out_p)
 
-    fname = f"cells_{args.img_min}_{args.img_max}_images_{num_images}.csv"
+    fname = f"cells_{img_min}_{img_max}_images_{num_images}.csv"
     logging.info(f"Write to {os.path.join(out_p, fname)}")
     with open(os.path.join(out_p, fname), "w") as f:
         cells_writer = csv.writer(f, delimiter=",")
@@ -155,27 +493,24 @@ def write_output(args, img_container, h, num_images, out_p):
             ]
         )
 
-        # write dict
-        i = 0
-        cell2class = {}
-        coords_sum = {}
-
-        # generate class ids for each hex cell id
-        for k in h.keys():
-            cell2class[k] = i
-            coords_sum[k] = [0, 0]
-            i = i + 1
-
-        # calculate mean GPS coordinate in each cell
-        for img in img_container:
-            coords_sum[img[3]][0] = coords_sum[img[3]][0] + img[1]
-            coords_sum[img[3]][1] = coords_sum[img[3]][1] + img[2]
-
         # write partitioning information
-        for k, v in h.items():
-            cells_writer.writerow(
-                [cell2class[k], k, v, coords_sum[k][0] / v, coords_sum[k][1] / v]
-            )
+        for row in cells.itertuples(index=False, name=None):
+            cells_writer.writerow(row)
+    return os.path.join(out_p, fname)
+
+
+def cells_to_frame(img_container, h):
+    # class ids follow the cell id order
+    coords_mean = img_container.coords_mean(h.start, h.end)
+    return pd.DataFrame(
+        {
+            "class_label": np.arange(len(h.cell_ids)),
+            "hex_id": cell_id_to_token(h.cell_ids),
+            "imgs_per_cell": h.counts,
+            "latitude_mean": coords_mean[:, 0],
+            "longitude_mean": coords_mean[:, 1],
+        }
+    )
 
 
 def main():
@@ -191,46 +526,142 @@ def main():
         level=level,
     )
 
-    # read dataset
-    df = pd.read_csv(
-        args.dataset, usecols=[args.column_img_path, args.column_lat, args.column_lng]
+    if args.update is not None:
+        # aggregate new images on the same level as the stored ones
+        state, args.lvl_max, num_images_state = load_state(args.state)
+        logging.info(f"Loaded {num_images_state} images from {args.state}")
+        check_update_files(args.update, num_images_state)
+
+    # read dataset, chunk by chunk if requested, and aggregate images per cell
+    # of the finest possible level
+    start = time()
+    reader = pd.read_csv(
+        args.dataset,
+        usecols=[args.column_img_path, args.column_lat, args.column_lng],
+        chunksize=args.chunksize,
     )
-    img_container = list(df.itertuples(index=False, name=None))
-    num_images = len(img_container)
+    if args.chunksize is None:
+        reader = [reader]
+    stats = None
+    num_images = 0
+    for df in reader:
+        num_images += len(df.index)
+        lats = df[args.column_lat].to_numpy(dtype=np.float64)
+        lngs = df[args.column_lng].to_numpy(dtype=np.float64)
+        leaf_ids = latlng_to_cell_id(lats, lngs)
+        chunk_stats = compute_cell_stats(leaf_ids, lats, lngs, args.lvl_max)
+        stats = chunk_stats if stats is None else merge_cell_stats(stats, chunk_stats)
+        logging.debug(f"{num_images} images read - {len(stats.cell_ids)} cells")
     logging.info("{} images available.".format(num_images))
+
+    if args.update is not None:
+        delta = ImageContainer.from_stats(stats)
+        stats = merge_cell_stats(state, stats)
+        num_images += num_images_state
+        del state
+
+    img_container = ImageContainer.from_stats(stats)
+    logging.info(
+        f"Time: {time() - start:.2f}s - "
+        f"Number of level {args.lvl_max} cells: {len(img_container.cell_ids)}"
+    )
     level = args.lvl_min
 
     # create output directory
     if not os.path.exists(args.output):
         os.makedirs(args.output)
 
-    # initialize
-    logging.info("Initialize cells of level {} ...".format(level))
-    start = time()
-    img_container, h = init_cells(img_container, level)
-    logging.info(f"Time: {time() - start:.2f}s - Number of classes: {len(h)}")
-
-    logging.info("Remove cells with |img| < t_min ...")
-    start = time()
-    img_container, h = delete_cells(img_container, h, args.img_min)
-    logging.info(f"Time: {time() - start:.2f}s - Number of classes: {len(h)}")
-
-    logging.info("Create subcells ...")
-    while any(v > args.img_max for v in h.values()) and level < args.lvl_max:
-        level = level + 1
-        logging.info("Level {}".format(level))
+    # written partitionings: output file -> cells
+    partitionings = {}
+    if args.update is not None:
+        for cells_file, img_min, img_max in zip(
+            args.update, args.img_min, args.img_max
+        ):
+            logging.info(f"Update {cells_file} ...")
+            start = time()
+            cells = update_cells(
+                read_cells(cells_file),
+                img_container,
+                delta,
+                img_min,
+                img_max,
+                level,
+                args.lvl_max,
+            )
+            logging.info(
+                f"Time: {time() - start:.2f}s - Number of classes: {len(cells.index)}"
+            )
+            out_file = write_output(cells, img_min, img_max, num_images, args.output)
+            partitionings[out_file] = cells
+    else:
+        # initialize
+        logging.info("Initialize cells of level {} ...".format(level))
         start = time()
-        img_container, h = gen_subcells(img_container, h, level, args.img_max)
-        logging.info(f"Time: {time() - start:.2f}s - Number of classes: {len(h)}")
+        h = init_cells(img_container, level)
+        logging.info(
+            f"Time: {time() - start:.2f}s - Number of classes: {len(h.cell_ids)}"
+        )
 
-    logging.info("Remove cells with |img| < t_min ...")
-    start = time()
-    img_container, h = delete_cells(img_container, h, args.img_min)
-    logging.info(f"Time: {time() - start:.2f}s - Number of classes: {len(h)}")
-    logging.info(f"Number of images: {len(img_container)}")
+        # one tree for all partitionings, split down to the smallest img_max
+        logging.info("Create subcells ...")
+        tree = build_cell_tree(img_container, h, level, args.lvl_max, min(args.img_max))
+
+        for img_min, img_max in zip(args.img_min, args.img_max):
+            logging.info(f"Select cells for img_min={img_min}, img_max={img_max} ...")
+            start = time()
+            h = select_cells(tree, img_min, img_max)
+            logging.info(
+                f"Time: {time() - start:.2f}s - Number of classes: {len(h.cell_ids)} - "
+                f"Number of images: {h.counts.sum()}"
+            )
 
-    logging.info("Write output file ...")
-    write_output(args, img_container, h, num_images, args.output)
+            logging.info("Write output file ...")
+            cells = cells_to_frame(img_container, h)
+            out_file = write_output(cells, img_min, img_max, num_images, args.output)
+            partitionings[out_file] = cells
+
+    if args.label_mapping is not None:
+        logging.info("Assign classes to images ...")
+        start = time()
+        indexes = {
+            Path(out_file).stem: CellIndex.from_tokens(
+                cells["hex_id"], cells["class_label"].to_numpy(dtype=np.int32)
+            )
+            for out_file, cells in partitionings.items()
+        }
+        if args.chunksize is None:
+            # the single chunk and its leaf cells are still in memory
+            df_mapping = assign_cell_classes(
+                df[args.column_img_path].to_numpy(), leaf_ids, indexes
+            )
+        else:
+            # second pass over the dataset
+            df_mapping = pd.concat(
+                assign_classes(
+                    chunk,
+                    args.column_img_path,
+                    args.column_lat,
+                    args.column_lng,
+                    indexes,
+                )
+                for chunk in pd.read_csv(
+                    args.dataset,
+                    usecols=[args.column_img_path, args.column_lat, args.column_lng],
+                    chunksize=args.chunksize,
+                )
+            )
+        # images in deleted cells have no class in at least one partitioning
+        assigned = (df_mapping >= 0).all(axis="columns")
+        logging.info(f"Images without class: {(~assigned).sum()}")
+        df_mapping = df_mapping[assigned]
+        logging.info(f"Write {len(df_mapping.index)} images to {args.label_mapping}")
+        write_label_mapping(df_mapping, args.label_mapping)
+        logging.info(f"Time: {time() - start:.2f}s")
+
+    # stored last, i.e. a failed run doesn't add its images to the state
+    if args.state is not None:
+        logging.info(f"Store aggregated images to {args.state}")
+        save_state(args.state, stats, args.lvl_max, num_images)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+import io
+import logging
+from itertools import islice
+
+import msgpack
+import pytest
+import torch
+from PIL import Image
+
+from classification.dataset import MsgPackIterableDatasetMultiTargetWithDynLabels
+from classification.shard_index import write_shard_index
+
+SHARD_SIZES = [17, 25, 13, 30, 21, 16]
+
+
+@pytest.fixture
+def shards(tmp_path):
+    """Indexed shards of 122 records img0, img1, ... with their number as target"""
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(buf, "JPEG")
+    mapping, n = {}, 0
+    for s, size in enumerate(SHARD_SIZES):
+        shard_path = tmp_path / f"shard_{s}.msg"
+        with open(shard_path, "wb") as f:
+            for _ in range(size):
+                f.write(msgpack.packb({"id": f"img{n}", "image": buf.getvalue()}))
+                mapping[f"img{n}"] = n
+                n += 1
+        write_shard_index(shard_path)
+    return tmp_path, mapping
+
+
+def make_dataset(shards, **kwargs):
+    path, mapping = shards
+    kwargs = {
+        "shuffle": False,
+        "readahead_mb": 0,
+        "rank": 0,
+        "world_size": 1,
+        **kwargs,
+    }
+    return MsgPackIterableDatasetMultiTargetWithDynLabels(path, dict(mapping), **kwargs)
+
+
+def test_ranks_yield_the_same_number_of_samples(shards, caplog):
+    caplog.set_level(logging.INFO)
+    counts, part_samples = [], []
+    for rank in range(2):
+        dataset = make_dataset(shards, rank=rank, world_size=2)
+        part = dataset._parts(1)[rank]
+        part_samples.append(sum(len(dataset.shard_records[i]) for i in part))
+        targets = [target for _, target in dataset]
+        assert len(set(targets)) == len(targets)
+        counts.append(len(targets))
+
+    # the surplus of the larger part is skipped and logged
+    assert counts == [min(part_samples)] * 2
+    rank = part_samples.index(max(part_samples))
+    skipped = max(part_samples) - min(part_samples)
+    assert skipped > 0
+    assert [r.getMessage() for r in caplog.records if "skip" in r.getMessage()] == [
+        f"Rank {rank} worker 0: skip {skipped} of {max(part_samples)} samples in "
+        "epoch 0 to yield as many samples as the other ranks"
+    ]
+
+
+def iterate_interrupted(shards, cuts, num_workers=0, **kwargs):
+    """Targets of an epoch interrupted after each number of samples of cuts. Each
+    segment continues from the state_dict of the previous one, like training resumed
+    from a checkpoint. Returns the targets and the state of each interruption.
+    """
+    targets, states, state = [], [], None
+    for cut in cuts + [None]:
+        dataset = make_dataset(shards, **kwargs)
+        dataset.track_progress(num_workers)
+        if state is not None:
+            dataset.load_state_dict(state)
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=None, num_workers=num_workers
+        )
+        targets += [int(target) for _, target in islice(loader, cut)]
+        state = dataset.state_dict()
+        states.append(state)
+    return targets, states[:-1]
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+@pytest.mark.parametrize("readahead_mb", [0, 1])
+def test_resume_twice(shards, shuffle, readahead_mb):
+    # samples of the shuffle buffers and the readahead are read again
+    targets, states = iterate_interrupted(
+        shards,
+        [30, 50],
+        shuffle=shuffle,
+        shuffle_buffer_mb=0.005,
+        readahead_mb=readahead_mb,
+    )
+    assert sorted(targets) == list(range(len(shards[1])))
+
+
+def test_resume_without_index(shards):
+    # the shuffle buffer at the interruption is skipped
+    path, mapping = shards
+    for index_file in path.glob("*.idx.npy"):
+        index_file.unlink()
+    targets, (state,) = iterate_interrupted(
+        shards, [30], shuffle=True, shuffle_buffer_mb=0.005
+    )
+    ((_, _, num_records),) = state["workers"]
+    assert num_records > 30
+    assert len(set(targets)) == len(targets)
+    assert len(targets) == len(mapping) - (num_records - 30)
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_resume_distributed(shards, shuffle):
+    # checkpoints hold the state of rank 0, other ranks continue after the number of
+    # samples rank 0 passed on, i.e. not at their own shuffle buffers
+    kwargs = {"shuffle": shuffle, "shuffle_buffer_mb": 0.005, "world_size": 2}
+    epoch, targets, state = [], [], None
+    for rank in range(2):
+        dataset = make_dataset(shards, rank=rank, **kwargs)
+        epoch.append([int(target) for _, target in dataset])
+        dataset = make_dataset(shards, rank=rank, **kwargs)
+        dataset.track_progress(0)
+        targets.append([int(target) for _, target in islice(dataset, 20)])
+        if rank == 0:
+            state = dataset.state_dict()
+    for rank in range(2):
+        dataset = make_dataset(shards, rank=rank, **kwargs)
+        dataset.track_progress(0)
+        dataset.load_state_dict(state)
+        targets[rank] += [int(target) for _, target in dataset]
+
+    assert len(targets[0]) == len(targets[1]) == len(epoch[0])
+    assert sorted(targets[0]) == sorted(epoch[0])
+    # rank 1 repeats as many samples as it skips, at most the shuffle buffer of rank 0
+    repeated = len(targets[1]) - len(set(targets[1]))
+    assert len(set(epoch[1]) - set(targets[1])) == repeated
+    assert repeated <= len(state["pending"][0])
+    if not shuffle:
+        assert targets[1] == epoch[1]
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_resume_workers(shards, shuffle):
+    # samples prefetched by the data loader (2 per worker) are skipped
+    targets, states = iterate_interrupted(
+        shards, [30, 50], num_workers=2, shuffle=shuffle, shuffle_buffer_mb=0.005
+    )
+    assert len(set(targets)) == len(targets)
+    assert len(shards[1]) - len(targets) <= len(states) * 2 * 2
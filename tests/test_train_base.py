@@ -0,0 +1,78 @@
+from argparse import Namespace
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("pytorch_lightning")
+
+from classification import train_base
+from classification.s2_utils import partitionings_digest, read_compiled_partitionings
+
+CELLS_HEADER = (
+    "num_images: 20\n"
+    "min_concept_probability: ---\n"
+    "class_label,hex_id,imgs_per_cell,latitude_mean,longitude_mean\n"
+)
+
+
+@pytest.fixture
+def hparams(tmp_path, monkeypatch):
+    # small backbone instead of the pre-trained torchvision models
+    monkeypatch.setattr(
+        train_base.utils_global,
+        "build_base_model",
+        lambda arch: (torch.nn.Sequential(torch.nn.Flatten()), 4),
+    )
+    coarse = tmp_path / "cells_coarse.csv"
+    coarse.write_text(CELLS_HEADER + "0,874c,20,38.8,-109.1\n")
+    fine = tmp_path / "cells_fine.csv"
+    fine.write_text(CELLS_HEADER + "0,8749,12,38.6,-109.4\n1,874b,8,39.0,-108.9\n")
+    return Namespace(
+        arch="resnet18",
+        weights=None,
+        partitionings={
+            "files": [str(coarse), str(fine)],
+            "shortnames": ["coarse", "fine"],
+            "compiled": str(tmp_path / "compiled.npz"),
+        },
+    )
+
+
+def compiled_digest(hparams):
+    return str(read_compiled_partitionings(hparams.partitionings["compiled"])["digest"])
+
+
+def test_compiled_partitionings_outdated(hparams):
+    train_base.MultiPartitioningClassifier(hparams)
+    digest = compiled_digest(hparams)
+
+    # edited partitioning file, i.e. the digest of the cache does not match anymore
+    fine = hparams.partitionings["files"][1]
+    with open(fine, "a") as f:
+        f.write("2,874d,3,38.2,-109.9\n")
+    model = train_base.MultiPartitioningClassifier(hparams)
+
+    assert [len(p) for p in model.partitionings] == [1, 3]
+    assert compiled_digest(hparams) != digest
+    assert compiled_digest(hparams) == partitionings_digest(
+        hparams.partitionings["files"], hparams.partitionings["shortnames"]
+    )
+
+
+@pytest.mark.parametrize("truncate", [0, 10, -30])
+def test_compiled_partitionings_corrupt(hparams, truncate):
+    expected = train_base.MultiPartitioningClassifier(hparams)
+    compiled = hparams.partitionings["compiled"]
+    with open(compiled, "rb") as f:
+        data = f.read()
+    with open(compiled, "wb") as f:
+        f.write(data[:truncate])
+
+    model = train_base.MultiPartitioningClassifier(hparams)
+
+    assert [len(p) for p in model.partitionings] == [1, 2]
+    np.testing.assert_array_equal(
+        model.partitionings[1].lat_lng, expected.partitionings[1].lat_lng
+    )
+    assert compiled_digest(hparams) == expected._partitionings_digest